@@ -8,10 +8,9 @@ from pathlib import Path
 
 sys.path.append(str(Path(__file__).resolve().parents[2]))
 
-from pipelines.openweather import OpeanWeatherClient
-from pipelines.alphavantage import AlphaVantageClient
-from pipelines.earthquakes import EarthQuakeClient
-from datastore.datastore import DataStore
+from pipelines.runner import run
+from datastore.spool import Spool
+from datastore.compact import compact
 
 default_args = {
     "owner": "jorgos2305",
@@ -31,16 +30,35 @@ dag_weather = DAG(
     tags=["weather"]
 )
 
+# The fetch tasks only write their results into the spool, the drain task is the single writer of the
+# datastore. Fetchers of both DAGs can run at the same time, concurrent drains wait for each other
+def run_clients(*clients):
+    # the same runner as python -m pipelines run, the results go into the spool batch by batch
+    summary = run(list(clients), spool=Spool(), stream=True)
+    failed = {client: stats["error"] for client, stats in summary.items() if stats["error"] is not None}
+    if failed:
+        raise ValueError(f"Clients failed: {failed}")
+
 def fetch_weather():
-    weather_result = OpeanWeatherClient().fetch()
-    DataStore().store("weather", weather_result, "split_on")
+    run_clients("weather")
 
-PythonOperator(
+def drain_spool():
+    Spool().drain()
+
+fetch_weather_task = PythonOperator(
     task_id="fetch_weather",
     python_callable=fetch_weather,
     dag=dag_weather,
 )
 
+drain_weather_task = PythonOperator(
+    task_id="drain_spool",
+    python_callable=drain_spool,
+    dag=dag_weather,
+)
+
+fetch_weather_task >> drain_weather_task
+
 dag_daily = DAG(
     dag_id="daily_clients_pipeline",
     default_args={**default_args, "start_date": start_date.add(hours=13)},
@@ -50,21 +68,48 @@ dag_daily = DAG(
 )
 
 def fetch_quakes():
-    earthquake_result = EarthQuakeClient().fetch()
-    DataStore().store("earthquake", earthquake_result, "split_on")
+    run_clients("earthquake")
 
 def fetch_stocks():
-    stocks_result = AlphaVantageClient().fetch()
-    DataStore().store("stocks", stocks_result, "split_on")
+    run_clients("stocks")
 
-PythonOperator(
+fetch_quakes_task = PythonOperator(
     task_id="fetch_earthquake",
     python_callable=fetch_quakes,
     dag=dag_daily,
 )
 
-PythonOperator(
+fetch_stocks_task = PythonOperator(
     task_id="fetch_stocks",
     python_callable=fetch_stocks,
     dag=dag_daily,
 )
+
+drain_daily_task = PythonOperator(
+    task_id="drain_spool",
+    python_callable=drain_spool,
+    trigger_rule="all_done", # the result of one client is stored even if the other one failed
+    dag=dag_daily,
+)
+
+[fetch_quakes_task, fetch_stocks_task] >> drain_daily_task
+
+dag_maintenance = DAG(
+    dag_id="datastore_maintenance",
+    default_args={**default_args, "start_date": start_date.add(hours=3)},
+    schedule="0 3 * * 0",  # weekly on sunday at 03:00 local time, outside of the fetch runs
+    catchup=False,
+    tags=["maintenance"]
+)
+
+def compact_datastore():
+    report = compact()
+    print(f"size: {report['before']['size']} -> {report['after']['size']} bytes")
+    for metric in ("full_read", "range_query"):
+        print(f"{metric}: {report['before'][metric]:.4f} -> {report['after'][metric]:.4f} s")
+
+PythonOperator(
+    task_id="compact_datastore",
+    python_callable=compact_datastore,
+    dag=dag_maintenance,
+)
@@ -0,0 +1,65 @@
+import argparse
+import sys
+import tempfile
+import time
+import numpy as np
+import pandas as pd
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+
+from datastore.datastore import DataStore
+from pipelines.result import ClientResult
+
+def make_result(groups:int, rows_per_group:int, seed:int=0) -> ClientResult:
+    # weather like frame with one group per city
+    rng = np.random.default_rng(seed)
+    n_rows = groups * rows_per_group
+    cities = np.repeat([f"city_{i}" for i in range(groups)], rows_per_group)
+    df = pd.DataFrame({"city": cities,
+                       "country": "DE",
+                       "lon": rng.uniform(-180, 180, n_rows),
+                       "lat": rng.uniform(-90, 90, n_rows),
+                       "temperature": rng.normal(15, 10, n_rows),
+                       "humidity": rng.integers(0, 100, n_rows),
+                       "description": "overcast clouds",
+                       "timestamp": pd.Timestamp("2025-08-08") + pd.to_timedelta(rng.integers(0, 86400, n_rows), unit="s"),
+                       "split_on": cities})
+    # shuffle so the bulk path has to sort
+    df = df.sample(frac=1, random_state=seed).reset_index(drop=True)
+    metadata = [{"fetched_at": pd.Timestamp.now().isoformat(), "url": "http://localhost", "status": 200,
+                 "success_count": groups, "error_count": 0}]
+    return ClientResult(data=df, metadata=metadata, errors=[])
+
+# bulk indexes only the timestamp column, bulk_all every data column like append
+MODES = {"append": {"bulk": False},
+         "bulk": {"bulk": True},
+         "bulk_all": {"bulk": True, "index_columns": ["index", "city", "country", "lon", "lat", "temperature",
+                                                       "humidity", "description", "timestamp", "split_on"]}}
+
+def time_store(result:ClientResult, mode:str, directory:Path) -> tuple[float, int]:
+    # only the write is measured, the deduplication (keys=[]) and the rollups are switched off
+    store_path = directory / f"datastore_{mode}.h5"
+    datastore = DataStore(store_path, rollups=False)
+    start = time.perf_counter()
+    datastore.store("weather", result, "split_on", keys=[], **MODES[mode])
+    elapsed = time.perf_counter() - start
+    return elapsed, store_path.stat().st_size
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Compare per-group appends with bulk writes in DataStore.store")
+    parser.add_argument("--groups", type=int, nargs="+", default=[1_000, 10_000, 100_000])
+    parser.add_argument("--rows-per-group", type=int, default=12)
+    parser.add_argument("--modes", nargs="+", default=list(MODES), choices=list(MODES))
+    args = parser.parse_args()
+
+    print(f"{'groups':>8} {'mode':>8} {'seconds':>10} {'size [MB]':>10}")
+    for groups in args.groups:
+        result = make_result(groups, args.rows_per_group)
+        with tempfile.TemporaryDirectory() as directory:
+            for mode in args.modes:
+                elapsed, size = time_store(result, mode, Path(directory))
+                print(f"{groups:>8} {mode:>8} {elapsed:>10.2f} {size / 1e6:>10.2f}")
+
+if __name__ == "__main__":
+    main()
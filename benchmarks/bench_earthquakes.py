@@ -0,0 +1,71 @@
+import argparse
+import copy
+import json
+import sys
+import time
+import pandas as pd
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+
+from pipelines.earthquakes import EarthQuakeClient
+
+def make_response(events:int) -> dict:
+    # USGS like response with `events` features, built from an archived response
+    raw_directory = Path(__file__).resolve().parents[1].joinpath("data/raw/earthquakes")
+    with sorted(raw_directory.glob("*.json"))[0].open() as source:
+        response = json.load(source)
+    features = response["features"]
+    response["features"] = [copy.deepcopy(features[i % len(features)]) for i in range(events)]
+    for i, feature in enumerate(response["features"]):
+        feature["properties"]["time"] += i
+    return response
+
+def legacy_parse(response:dict) -> pd.DataFrame:
+    # the nested loops and apply passes the client used before the columnar parse
+    records = {"time":[], "mag":[], "magType":[], "alert":[], "tsunami":[], "place":[], "coordinates":[]}
+    for earthquake in response["features"]:
+        for feature in records:
+            if feature in earthquake["properties"]:
+                records[feature].append(earthquake["properties"][feature])
+            else:
+                records[feature].append(earthquake["geometry"][feature])
+    df = pd.DataFrame(records)
+    df["lon"] = df.coordinates.apply(lambda coord: coord[0])
+    df["lat"] = df.coordinates.apply(lambda coord: coord[1])
+    df["depth"] = df.coordinates.apply(lambda coord: coord[2])
+    df = df.drop("coordinates", axis=1)
+    df = df.rename(columns={"time":"timestamp", "mag":"magnitude", "magType":"scale"})
+    df = df.replace(EarthQuakeClient.MAGNITUDE_TYPE_DESCRIPTION)
+    df["timestamp"] = pd.to_datetime(df["timestamp"], unit="ms")
+    df["split_on"] = df["timestamp"].dt.strftime("date_%Y_%m_%d")
+    return df
+
+def best_of(function, repeat:int) -> float:
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Compare the legacy and the columnar parsing of USGS responses")
+    parser.add_argument("--events", type=int, default=20_000)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    response = make_response(args.events)
+    client = EarthQuakeClient()
+    columnar = lambda: client._to_dataframe(client._process(response))
+    pd.testing.assert_frame_equal(legacy_parse(response).reset_index(drop=True), columnar()[legacy_parse(response).columns], check_dtype=False)
+
+    legacy_seconds = best_of(lambda: legacy_parse(response), args.repeat)
+    columnar_seconds = best_of(columnar, args.repeat)
+    print(f"events:   {args.events}")
+    print(f"legacy:   {legacy_seconds:.3f} s")
+    print(f"columnar: {columnar_seconds:.3f} s")
+    print(f"speedup:  {legacy_seconds / columnar_seconds:.1f}x")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,235 @@
+import argparse
+import copy
+import json
+import sys
+import tempfile
+import time
+import requests
+from datetime import datetime
+from pathlib import Path
+from requests.adapters import BaseAdapter
+from typing import Callable, Dict, List, Tuple
+from urllib.parse import parse_qs, urlsplit
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+
+import pipelines.alphavantage
+import pipelines.earthquakes
+import pipelines.openweather
+from datastore.datastore import DataStore
+from pipelines.alphavantage import AlphaVantageClient
+from pipelines.earthquakes import EarthQuakeClient
+from pipelines.openweather import OpeanWeatherClient
+from pipelines.quota import DailyQuota
+from utils.archive import RawArchive
+from utils.geocoding_cache import GeocodingCache
+from utils.helpers import get_url, load_openweather_locations
+from utils.ratelimit import TokenBucket
+
+# Replays the archived API responses of data/raw through the clients without network access, scaled up to
+# any number of cities, symbols and events. Every stage of a client (fetch, process, store) is timed and the
+# results are saved as JSON. With --baseline the run is compared with an earlier result and fails on a regression.
+# usage: python benchmarks/bench_pipeline.py [--cities 10 1000] [--symbols 10 1000] [--events 1000 50000]
+#                                            [--baseline benchmarks/results/pipeline_....json]
+
+ROOT = Path(__file__).resolve().parents[1]
+RESULTS_DIRECTORY = ROOT.joinpath("benchmarks/results")
+
+def load_fixtures(api_name:str) -> List:
+    # every archived response of an API, the legacy JSON files and the compressed segments
+    archive = RawArchive(api_name)
+    return [raw_data for path in archive.files() for _, raw_data in archive.read(path)]
+
+class ReplayAdapter(BaseAdapter):
+    # Transport adapter that answers the requests of a session from a route function instead of the network.
+    # The response hooks of the session still run, so the received bytes are counted like for a live run
+    def __init__(self, route:Callable[[str, Dict[str, str]], Tuple[int, object]]) -> None:
+        super().__init__()
+        self.route = route
+
+    def send(self, request, **kwargs) -> requests.Response:
+        url = urlsplit(request.url)
+        params = {key: values[0] for key, values in parse_qs(url.query).items()}
+        status, payload = self.route(f"{url.scheme}://{url.netloc}{url.path}", params)
+        response = requests.Response()
+        response.status_code = status
+        response._content = json.dumps(payload).encode()
+        response.headers["Content-Type"] = "application/json"
+        response.url = request.url
+        response.request = request
+        response.reason = "OK" if status == 200 else "Error"
+        return response
+
+    def close(self) -> None:
+        pass
+
+def _same_url(url:str, source:str) -> bool:
+    return url.rstrip("/") == source.split("?")[0].rstrip("/")
+
+def weather_client(cities:int, directory:Path) -> OpeanWeatherClient:
+    # the configured cities are repeated with a suffix until there are `cities` of them,
+    # every weather request gets one of the archived responses with the requested coordinates
+    responses = [response for raw_data in load_fixtures("weather") for response in raw_data]
+    base = load_openweather_locations()
+    locations = [(f"{city}_{i // len(base)}" if i >= len(base) else city, country)
+                 for i, (city, country) in ((i, base[i % len(base)]) for i in range(cities))]
+    coordinates = {city: (-180 + 360 * (i + 0.5) / cities, -60 + 120 * ((i * 7919) % cities + 0.5) / cities)
+                   for i, (city, _) in enumerate(locations)}
+    url_geocoding, url_weather = get_url("geocoding"), get_url("weather")
+
+    def route(url:str, params:Dict[str, str]) -> Tuple[int, object]:
+        if _same_url(url, url_geocoding):
+            lon, lat = coordinates[params["q"]]
+            return 200, [{"name": params["q"], "lon": lon, "lat": lat, "country": "DE"}]
+        if _same_url(url, url_weather):
+            lon, lat = float(params["lon"]), float(params["lat"])
+            response = copy.deepcopy(responses[hash((lon, lat)) % len(responses)])
+            response["coord"] = {"lon": lon, "lat": lat}
+            return 200, response
+        return 404, {}
+
+    client = OpeanWeatherClient(max_workers=8)
+    client.locations = locations
+    client.cities = [city for city, _ in locations]
+    client.geocoding_cache = GeocodingCache(directory / "geocoding_cache.csv")
+    # the replayed API has no rate limit
+    client.rate_limiter = TokenBucket(1e9, capacity=10**9)
+    client.session.mount("https://", ReplayAdapter(route))
+    client.session.mount("http://", ReplayAdapter(route))
+    return client
+
+def stocks_client(symbols:int, directory:Path, datastore:DataStore) -> AlphaVantageClient:
+    # every symbol gets one of the archived daily series
+    series = [stocks for raw_data in load_fixtures("stocks") for response in raw_data for stocks in response.values()]
+    names = [f"SYM{i:05d}" for i in range(symbols)]
+    url = get_url("stocks")
+
+    def route(request_url:str, params:Dict[str, str]) -> Tuple[int, object]:
+        if not _same_url(request_url, url):
+            return 404, {}
+        return 200, {"Time Series (Daily)": series[names.index(params["symbol"]) % len(series)]}
+
+    client = AlphaVantageClient(datastore=datastore)
+    client.symbols = names
+    client.quota = DailyQuota(directory / "alphavantage_quota.json", symbols)
+    client.session.mount("https://", ReplayAdapter(route))
+    client.session.mount("http://", ReplayAdapter(route))
+    return client
+
+def earthquake_client(events:int) -> EarthQuakeClient:
+    # the archived events are repeated with shifted times until there are `events` of them,
+    # the pages are served by offset like the USGS API
+    features = [feature for raw_data in load_fixtures("earthquakes") for feature in raw_data["features"]]
+    template = load_fixtures("earthquakes")[0]
+    generated = []
+    for i in range(events):
+        feature = copy.deepcopy(features[i % len(features)])
+        feature["properties"]["time"] += i * 1000
+        generated.append(feature)
+    url = get_url("earthquake")
+
+    def route(request_url:str, params:Dict[str, str]) -> Tuple[int, object]:
+        if not _same_url(request_url, url):
+            return 404, {}
+        start = int(params["offset"]) - 1
+        return 200, {**template, "features": generated[start:start + int(params["limit"])]}
+
+    client = EarthQuakeClient()
+    client.session.mount("https://", ReplayAdapter(route))
+    client.session.mount("http://", ReplayAdapter(route))
+    return client
+
+def _size(path:Path) -> int:
+    if path.is_file():
+        return path.stat().st_size
+    return sum(file.stat().st_size for file in path.rglob("*") if file.is_file())
+
+def run_client(name:str, size:int, backend:str) -> Dict:
+    with tempfile.TemporaryDirectory() as tmp:
+        directory = Path(tmp)
+        store_path = directory / ("datastore.h5" if backend == "hdf5" else "datastore")
+        datastore = DataStore(store_path, backend=backend)
+        # the raw responses are archived like in a live run, but into the temporary directory
+        archive = lambda raw_data, api_name: RawArchive(api_name, directory=directory / "raw" / api_name).append(raw_data)
+        for module in (pipelines.openweather, pipelines.alphavantage, pipelines.earthquakes):
+            module.store = archive
+        if name == "weather":
+            client = weather_client(size, directory)
+        elif name == "stocks":
+            client = stocks_client(size, directory, datastore)
+        else:
+            client = earthquake_client(size)
+
+        with client.metrics.stage("fetch") as record:
+            result = client.fetch()
+            record["rows"] = len(result.data) if result.data is not None else 0
+            record["bytes"] = client.metrics.received_bytes
+        with client.metrics.stage("store") as record:
+            record["rows"] = datastore.store(client.NAME, result, client.SPLIT_ON, bulk=True)
+        stages = client.metrics.stages
+        seconds = stages["fetch"]["seconds"] + stages["store"]["seconds"]
+        return {"client": name,
+                "size": size,
+                "backend": backend,
+                "rows": stages["store"]["rows"],
+                "errors": len(result.errors or []),
+                "rows_per_second": stages["store"]["rows"] / seconds if seconds > 0 else 0.0,
+                "store_bytes": _size(store_path),
+                "stages": stages}
+
+def compare(results:List[Dict], baseline:List[Dict], tolerance:float) -> List[str]:
+    # a run is a regression if its throughput drops or its store grows by more than the tolerance
+    regressions = []
+    previous = {(result["client"], result["size"], result["backend"]): result for result in baseline}
+    for result in results:
+        before = previous.get((result["client"], result["size"], result["backend"]))
+        if before is None:
+            continue
+        label = f"{result['client']} {result['size']} {result['backend']}"
+        if result["rows_per_second"] < before["rows_per_second"] * (1 - tolerance):
+            regressions.append(f"{label}: {result['rows_per_second']:.0f} rows/s, baseline {before['rows_per_second']:.0f} rows/s")
+        if result["store_bytes"] > before["store_bytes"] * (1 + tolerance):
+            regressions.append(f"{label}: store {result['store_bytes']} bytes, baseline {before['store_bytes']} bytes")
+    return regressions
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Replay the archived API responses through the clients and the datastore")
+    parser.add_argument("--cities", type=int, nargs="*", default=[10, 1_000])
+    parser.add_argument("--symbols", type=int, nargs="*", default=[10, 1_000])
+    parser.add_argument("--events", type=int, nargs="*", default=[1_000, 50_000])
+    parser.add_argument("--backend", default="hdf5", help="storage backend, hdf5 or parquet")
+    parser.add_argument("--output", type=Path, default=None, help="defaults to benchmarks/results/pipeline_<time>.json")
+    parser.add_argument("--baseline", type=Path, default=None, help="earlier result to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed relative change before a run counts as regression")
+    args = parser.parse_args()
+
+    runs = [("weather", size) for size in args.cities] + [("stocks", size) for size in args.symbols] \
+         + [("earthquake", size) for size in args.events]
+    results = []
+    print(f"{'client':>10} {'size':>7} {'rows':>8} {'fetch s':>8} {'process s':>9} {'store s':>8} {'rows/s':>9} {'store MB':>9}")
+    for name, size in runs:
+        start = time.perf_counter()
+        result = run_client(name, size, args.backend)
+        result["wall_seconds"] = time.perf_counter() - start
+        results.append(result)
+        stages = result["stages"]
+        print(f"{name:>10} {size:>7} {result['rows']:>8} {stages['fetch']['seconds']:>8.2f} "
+              f"{stages.get('process', {}).get('seconds', 0.0):>9.2f} {stages['store']['seconds']:>8.2f} "
+              f"{result['rows_per_second']:>9.0f} {result['store_bytes'] / 2**20:>9.2f}")
+
+    output = args.output or RESULTS_DIRECTORY.joinpath(f"pipeline_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json")
+    output.parent.mkdir(parents=True, exist_ok=True)
+    with output.open("w") as target:
+        json.dump({"created_at": datetime.now().isoformat(), "results": results}, target, indent=4)
+    print(f"results saved to {output}")
+
+    if args.baseline is not None:
+        with args.baseline.open() as source:
+            regressions = compare(results, json.load(source)["results"], args.tolerance)
+        for regression in regressions:
+            print(f"regression: {regression}")
+        if regressions:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,55 @@
+import threading
+import pandas as pd
+from collections import OrderedDict
+from typing import Dict, Hashable, Tuple
+
+class QueryCache:
+    # Size bounded LRU cache for the frames read from the store.
+    # Keys are (node, query) tuples, so every entry of a node can be dropped when the node is written
+    def __init__(self, max_bytes:int=64 * 2**20) -> None:
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries:OrderedDict[Tuple[str, Hashable], Tuple[pd.DataFrame, int]] = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, node:str, query:Hashable) -> pd.DataFrame|None:
+        with self._lock:
+            entry = self._entries.get((node, query))
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end((node, query))
+        # the caller gets its own copy, the cached frame must not be modified
+        return entry[0].copy()
+
+    def put(self, node:str, query:Hashable, df:pd.DataFrame) -> None:
+        size = int(df.memory_usage(index=True, deep=True).sum())
+        if size > self.max_bytes:
+            # larger than the whole cache, it would only evict everything else
+            return
+        with self._lock:
+            if (node, query) in self._entries:
+                self._bytes -= self._entries.pop((node, query))[1]
+            self._entries[(node, query)] = (df.copy(), size)
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self._bytes -= evicted_size
+                self.evictions += 1
+
+    def invalidate(self, node:str) -> None:
+        with self._lock:
+            for key in [key for key in self._entries if key[0] == node]:
+                self._bytes -= self._entries.pop(key)[1]
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {"hits": self.hits,
+                    "misses": self.misses,
+                    "evictions": self.evictions,
+                    "entries": len(self._entries),
+                    "bytes": self._bytes}
@@ -0,0 +1,95 @@
+import argparse
+import os
+import time
+import pandas as pd
+from pathlib import Path
+from typing import Dict, List
+
+from datastore.hdf5 import HDF5Backend
+
+# Repacks the HDF5 datastore. Many small appends leave every node with tiny chunks and HDF5 never gives
+# back the space of removed nodes. Every node is rewritten in one piece into a new file (chunk shape sized
+# for the whole node), compressed and with completely sorted indexes. The new file replaces the old one
+# atomically. The writer lock of the store is held from the start of the repack until the replace, every
+# write (runner, drain, backfill, streams) waits for it, so no row written in between is lost.
+# usage: python -m datastore.compact [--store data/processed/datastore.h5] [--complib blosc:zstd] [--complevel 5]
+
+ROOT = Path(__file__).resolve().parents[1]
+
+def _indexed_columns(datastore:pd.HDFStore, key:str) -> List[str]:
+    table = datastore.get_storer(key).table
+    return [name for name, indexed in table.colindexed.items() if indexed]
+
+def _string_widths(datastore:pd.HDFStore, key:str) -> Dict[str,int]:
+    # the widths of the string columns are kept, later appends still fit into the repacked node
+    table = datastore.get_storer(key).table
+    return {name: table.coldescrs[name].itemsize for name in table.colnames
+            if table.coldescrs[name].kind == "string" and name != "index"}
+
+def read_latency(store_path:Path, repeat:int=3) -> Dict[str, float]:
+    # best of `repeat` for reading every node completely and for a range query on the last day of every data node
+    full, ranged = [], []
+    with pd.HDFStore(store_path, "r") as datastore:
+        keys = datastore.keys()
+        ranges = {}
+        for key in keys:
+            table = datastore.get_storer(key).table
+            if "/data/" in key and table.nrows > 0:
+                column = "timestamp" if "timestamp" in table.colnames else "index"
+                values = datastore.select_column(key, column)
+                if pd.api.types.is_datetime64_any_dtype(values):
+                    ranges[key] = (column, values.max() - pd.Timedelta(days=1))
+        for _ in range(repeat):
+            start = time.perf_counter()
+            for key in keys:
+                datastore.select(key)
+            full.append(time.perf_counter() - start)
+            start = time.perf_counter()
+            for key, (column, since) in ranges.items():
+                datastore.select(key, where=f"{column} >= since")
+            ranged.append(time.perf_counter() - start)
+    return {"full_read": min(full), "range_query": min(ranged)}
+
+def repack(source:Path, target:Path, complib:str="blosc:zstd", complevel:int=5) -> Dict[str, int]:
+    rows = {}
+    with pd.HDFStore(source, "r") as datastore, pd.HDFStore(target, "w", complib=complib, complevel=complevel) as repacked:
+        for key in datastore.keys():
+            df = datastore.select(key)
+            indexed = _indexed_columns(datastore, key)
+            # expectedrows lets PyTables size the chunks for the whole node instead of the first append
+            repacked.append(key, df, format="table", data_columns=True, min_itemsize=_string_widths(datastore, key) or None,
+                            expectedrows=max(len(df), 1), index=False)
+            if indexed:
+                repacked.create_table_index(key, columns=indexed, optlevel=9, kind="full")
+            rows[key] = len(df)
+    return rows
+
+def compact(store_path:Path|None=None, complib:str="blosc:zstd", complevel:int=5) -> Dict[str, Dict[str, float]]:
+    store_path = Path(store_path) if store_path is not None else ROOT.joinpath("data/processed/datastore.h5")
+    if not store_path.exists():
+        raise ValueError(f"Datastore not found: {store_path}")
+    tmp_path = store_path.with_name(f".{store_path.name}.repack")
+    with HDF5Backend(store_path).locked():
+        before = {"size": store_path.stat().st_size, **read_latency(store_path)}
+        rows = repack(store_path, tmp_path, complib, complevel)
+        with pd.HDFStore(tmp_path, "r") as repacked:
+            missing = [key for key, count in rows.items() if repacked.get_storer(key).nrows != count]
+        if missing:
+            tmp_path.unlink()
+            raise ValueError(f"Repacked nodes do not match the datastore: {missing}")
+        os.replace(tmp_path, store_path)
+        after = {"size": store_path.stat().st_size, **read_latency(store_path)}
+    return {"before": before, "after": after}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Repack the HDF5 datastore with compression and sorted indexes")
+    parser.add_argument("--store", type=Path, default=None, help="path of the HDF5 file, defaults to data/processed/datastore.h5")
+    parser.add_argument("--complib", default="blosc:zstd")
+    parser.add_argument("--complevel", type=int, default=5)
+    args = parser.parse_args()
+
+    report = compact(args.store, args.complib, args.complevel)
+    print(f"{'':12} {'before':>12} {'after':>12}")
+    print(f"{'size (MB)':12} {report['before']['size'] / 2**20:12.2f} {report['after']['size'] / 2**20:12.2f}")
+    for metric in ("full_read", "range_query"):
+        print(f"{metric + ' (s)':12} {report['before'][metric]:12.4f} {report['after'][metric]:12.4f}")
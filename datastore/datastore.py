@@ -1,56 +1,177 @@
+import numpy as np
 import pandas as pd
+from datetime import datetime
 from pathlib import Path
-from typing import List, Dict
+from typing import List, Dict, Tuple
 
+from datastore.cache import QueryCache
+from datastore.hdf5 import HDF5Backend
+from datastore.keys import KeyIndex
+from datastore.parquet import ParquetBackend
+from datastore.rollups import ROLLUPS
+from datastore.watermarks import WatermarkIndex
 from pipelines.result import ClientResult
 
 class DataStore:
+    # The storage itself is done by a backend:
+    # "hdf5" -> one HDF5 file with a table node per group (data/processed/datastore.h5)
+    # "parquet" -> partitioned parquet dataset that allows concurrent writers (data/processed/datastore)
+    DEFAULT_PATHS = {"hdf5": "data/processed/datastore.h5", "parquet": "data/processed/datastore"}
+    # natural key of the rows of a data node, rows whose key is already stored are not appended again.
+    # The nodes are split by city, symbol and day, so e.g. the timestamp alone identifies a weather row.
+    # Earthquakes have the event id of USGS, the time and the location of an event are revised later
+    KEYS = {"weather": ["timestamp"], "stocks": ["index"], "earthquake": ["id"]}
 
-    def __init__(self):
-        self.store_path = Path(__file__).resolve().parents[1].joinpath("data/processed/datastore.h5")
-        self._default_min_itemsize = 15
-    
-    def _update_min_itemsize(self, df:pd.DataFrame|None) -> int:
-        # to avoid min_size problems when storing string columns
-        min_item_size = self._default_min_itemsize
-        if df is not None and not df.empty:
-            for col in df.select_dtypes(include=["object", "string"]).columns:
-                entry_len = df[col].astype(str).map(len).max()
-                min_item_size = max(self._default_min_itemsize, entry_len)
-        return min_item_size
-
-    
-    def store(self, client:str, result:ClientResult, split_on:str):
+    def __init__(self, store_path:Path|None=None, itemsize_headroom:float=0.0, cache_bytes:int=64 * 2**20, backend:str="hdf5",
+                 rollups:bool=True):
+        if backend not in DataStore.DEFAULT_PATHS:
+            raise ValueError(f"Invalid storage backend: {backend}")
+        if store_path is None:
+            store_path = Path(__file__).resolve().parents[1].joinpath(DataStore.DEFAULT_PATHS[backend])
+        self.store_path = Path(store_path)
+        if backend == "hdf5":
+            self.backend = HDF5Backend(self.store_path, itemsize_headroom)
+        else:
+            self.backend = ParquetBackend(self.store_path)
+        self.watermarks_directory = self.store_path.parent / "watermarks"
+        # frames read by query() are kept in memory until the node is written again
+        self.cache = QueryCache(cache_bytes)
+        self.key_index = KeyIndex()
+        # daily/weekly aggregates maintained after every store, see datastore/rollups.py
+        self.rollups = ROLLUPS if rollups else {}
+
+    def get_watermarks(self, client:str) -> Dict[str, pd.Timestamp]:
+        # last stored index value per group of a client, read from a small JSON file instead of the store
+        watermarks = WatermarkIndex(self.watermarks_directory, client)
+        if not watermarks.exists() and self.backend.exists():
+            # one time migration for stores written before the watermarks existed
+            marks = self.backend.last_index(client)
+            if marks:
+                watermarks.update(marks)
+        return watermarks.load()
+
+    def _update_watermarks(self, client:str, df:pd.DataFrame, split_on:str) -> None:
+        # only time series with a datetime index (e.g. the daily stocks) have watermarks
+        if not isinstance(df.index, pd.DatetimeIndex):
+            return
+        marks = df.index.to_series().groupby(df[split_on].to_numpy()).max()
+        WatermarkIndex(self.watermarks_directory, client).update(marks.to_dict())
+
+    def _load_keys(self, client:str, groups:List[str], keys:List[str]) -> None:
+        # reads only the key columns of the nodes that are not loaded yet, all of them in one read
+        missing = [group for group in groups if not self.key_index.loaded(f"/{client}/data/{group}")]
+        if not missing:
+            return
+        stored = self.backend.read_columns(client, missing, keys)
+        for group in missing:
+            frame = stored.get(group)
+            hashes = KeyIndex.hash(frame, keys) if frame is not None and len(frame) > 0 else np.empty(0, dtype=np.uint64)
+            self.key_index.load(f"/{client}/data/{group}", hashes)
+
+    def _drop_duplicates(self, client:str, df:pd.DataFrame, split_on:str, keys:List[str]) -> Tuple[pd.DataFrame, Dict[str, np.ndarray]]:
+        # Drops the rows whose key is already stored in their node or appears twice in the frame.
+        # Returns the new rows and their hashes per node, which are added to the index after the write
+        hashes = KeyIndex.hash(df, keys)
+        groups = df[split_on].to_numpy()
+        keep = ~pd.DataFrame({"group": groups, "hash": hashes}).duplicated().to_numpy()
+        # row positions of every group in one pass instead of comparing the whole column once per group
+        positions = pd.Series(groups).groupby(groups, sort=False).indices
+        self._load_keys(client, list(positions), keys)
+        new_hashes = {}
+        for group, rows in positions.items():
+            node = f"/{client}/data/{group}"
+            keep[rows] &= ~self.key_index.contains(node, hashes[rows])
+            new_hashes[node] = hashes[rows[keep[rows]]]
+        return df[keep], new_hashes
+
+    def store(self, client:str, result:ClientResult, split_on:str, bulk:bool=False, index_columns:List[str]|None=None,
+              keys:List[str]|None=None) -> int:
+        # keys defaults to the natural key of the client, rows without a known key are not deduplicated.
+        # Returns the number of stored data rows
         if not client:
             raise ValueError(f"Invalid name for client: {client}")
         if not split_on:
             raise ValueError(f"Invalid column name for splitting: {split_on}")
         
-        min_itemsize = self._default_min_itemsize
-        if result.data is None:
-            min_itemsize = max(min_itemsize, self._update_min_itemsize(result.data))
-        if result.metadata is not None:
-            min_itemsize = max(min_itemsize, self._update_min_itemsize(pd.DataFrame(result.metadata)))
-        if result.errors is not None:
-            min_itemsize = max(min_itemsize, self._update_min_itemsize(pd.DataFrame(result.errors)))
-        
-        
-        with pd.HDFStore(self.store_path, "a") as datastore:
-            # Make sure there is a column on which it can be grouped on
-            if result.data is not None and not result.data.empty:
-                if split_on not in result.data.columns:
-                    raise ValueError(f"{split_on} not found in Dataframe columns: {result.data.columns}")
-        
-                for group, data in result.data.groupby(split_on):
-                    datastore.append(f"{client}/data/{group}", data, format="table", data_columns=True, min_itemsize=min_itemsize)
-            
-            if result.metadata is not None and len(result.metadata) > 0:
-                metadata_df = pd.DataFrame(result.metadata)
-                datastore.append(f"{client}/metadata", metadata_df, format="table", data_columns=True, min_itemsize=min_itemsize)
-
-            if result.errors is not None and len(result.errors) > 0:
-                errors_df = pd.DataFrame(result.errors)
-                datastore.append(f"{client}/errors", errors_df, format="table", data_columns=True, min_itemsize=min_itemsize)
+        # Make sure there is a column on which it can be grouped on
+        if result.data is not None and not result.data.empty:
+            if split_on not in result.data.columns:
+                raise ValueError(f"{split_on} not found in Dataframe columns: {result.data.columns}")
+
+        keys = keys if keys is not None else DataStore.KEYS.get(client)
+        new_hashes = {}
+        if keys and result.data is not None and not result.data.empty:
+            data, new_hashes = self._drop_duplicates(client, result.data, split_on, keys)
+            result = ClientResult(data=data, metadata=result.metadata, errors=result.errors, metrics=result.metrics)
+
+        for key in self.backend.write(client, result, split_on, bulk=bulk, index_columns=index_columns):
+            self.cache.invalidate(key)
+        for node, hashes in new_hashes.items():
+            self.key_index.add(node, hashes)
+
+        # the watermarks and rollups are only updated once the rows are safely in the store
+        if result.data is not None and not result.data.empty:
+            self._update_watermarks(client, result.data, split_on)
+            self.update_rollups(client, result.data)
+            return len(result.data)
+        return 0
+
+    def update_rollups(self, client:str, df:pd.DataFrame) -> None:
+        # Only the new rows are aggregated, the result is merged with the stored rollup rows of the touched
+        # periods. The rows are deduplicated before, so no row is counted twice. Concurrent updates of a client
+        # wait for each other, otherwise both would merge into the same stored rows and one update would be lost
+        if df.empty or not self.rollups.get(client):
+            return
+        with self.backend.rollups_locked(client):
+            for rollup in self.rollups[client]:
+                partial = rollup.partial(df)
+                if partial.empty:
+                    continue
+                start_ts, end_ts = partial["period"].min(), partial["period"].max()
+                stored = self.backend.read_rollup(client, rollup.name, start_ts, end_ts)
+                merged = rollup.merge(pd.concat([stored, partial]) if not stored.empty else partial)
+                self.backend.replace_rollup(client, rollup.name, merged, start_ts, end_ts)
+
+    def rollup(self, client:str, name:str, keys:List[str]|None=None, start:datetime|None=None, end:datetime|None=None) -> pd.DataFrame:
+        # Aggregates of the periods starting in [start, end], e.g. rollup("weather", "daily", ["Berlin"]).
+        # Reads one row per key and period instead of the stored rows
+        rollups = {rollup.name: rollup for rollup in self.rollups.get(client, [])}
+        if name not in rollups:
+            raise ValueError(f"Unknown rollup for {client}: {name}")
+        rollup = rollups[name]
+        stored = self.backend.read_rollup(client, name, pd.Timestamp(start) if start is not None else None,
+                                          pd.Timestamp(end) if end is not None else None)
+        if keys is not None and not stored.empty:
+            stored = stored[stored[rollup.key].isin(keys)]
+        return rollup.finalize(stored)
+
+    def query(self, client:str, groups:List[str]|None=None, start:datetime|None=None, end:datetime|None=None,
+              columns:List[str]|None=None) -> pd.DataFrame:
+        # Reads the rows of [start, end) from the data nodes of a client. The backend pushes the time range
+        # down to the storage and reads only the requested columns, all groups are read in one pass.
+        # The frame of every node is cached, the storage is only read for the nodes that are not cached
+        if columns is not None and "split_on" not in columns:
+            # keep track of the group of every row
+            columns = [*columns, "split_on"]
+        start_ts = pd.Timestamp(start) if start is not None else None
+        end_ts = pd.Timestamp(end) if end is not None else None
+        query = (start_ts, end_ts, tuple(columns) if columns is not None else None)
+
+        if groups is None:
+            groups = self.backend.groups(client)
+        frames = {}
+        for group in groups:
+            cached = self.cache.get(f"/{client}/data/{group}", query)
+            if cached is not None:
+                frames[group] = cached
+        missing = [group for group in groups if group not in frames]
+        if missing:
+            for group, df in self.backend.read(client, missing, start_ts, end_ts, columns).items():
+                frames[group] = df
+                self.cache.put(f"/{client}/data/{group}", query, df)
+        if not frames:
+            return pd.DataFrame(columns=columns)
+        return pd.concat([frames[group] for group in groups if group in frames])
 
 
 if __name__ == "__main__":
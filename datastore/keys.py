@@ -0,0 +1,47 @@
+import threading
+import numpy as np
+import pandas as pd
+from typing import Dict, List
+
+class KeyIndex:
+    # Natural keys of the stored rows, kept as one sorted array of 64 bit hashes per node (8 bytes per row).
+    # A node is only loaded when rows are stored into it for the first time
+    def __init__(self) -> None:
+        self._hashes:Dict[str, np.ndarray] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def hash(df:pd.DataFrame, keys:List[str]) -> np.ndarray:
+        # "index" refers to the index of the frame, e.g. the date of the daily stocks
+        columns = {}
+        for key in keys:
+            values = pd.Series(df.index if key == "index" else df[key].to_numpy())
+            if pd.api.types.is_datetime64_any_dtype(values):
+                # the backends return different resolutions for the same timestamp
+                values = values.astype("datetime64[ns]")
+            elif not pd.api.types.is_numeric_dtype(values):
+                values = values.astype(object)
+            columns[key] = values.to_numpy()
+        return pd.util.hash_pandas_object(pd.DataFrame(columns), index=False).to_numpy()
+
+    def loaded(self, node:str) -> bool:
+        with self._lock:
+            return node in self._hashes
+
+    def load(self, node:str, hashes:np.ndarray) -> None:
+        with self._lock:
+            self._hashes[node] = np.unique(hashes)
+
+    def contains(self, node:str, hashes:np.ndarray) -> np.ndarray:
+        # one binary search per new row instead of comparing against the stored rows
+        with self._lock:
+            stored = self._hashes.get(node, np.empty(0, dtype=np.uint64))
+        if len(stored) == 0:
+            return np.zeros(len(hashes), dtype=bool)
+        positions = np.minimum(np.searchsorted(stored, hashes), len(stored) - 1)
+        return stored[positions] == hashes
+
+    def add(self, node:str, hashes:np.ndarray) -> None:
+        with self._lock:
+            if node in self._hashes:
+                self._hashes[node] = np.union1d(self._hashes[node], hashes)
@@ -0,0 +1,16 @@
+import fcntl
+from contextlib import contextmanager
+from pathlib import Path
+
+@contextmanager
+def file_lock(path:Path):
+    # Exclusive flock on a lock file, waits until the holder releases it. The file is opened again on
+    # every call, so threads of the same process exclude each other like separate processes do
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with path.open("a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
@@ -0,0 +1,46 @@
+import argparse
+import pandas as pd
+from pathlib import Path
+from typing import Dict
+
+from datastore.parquet import ParquetBackend
+
+# Copies an HDF5 datastore into the parquet backend, node by node.
+# usage: python -m datastore.migrate [--source data/processed/datastore.h5] [--target data/processed/datastore]
+
+ROOT = Path(__file__).resolve().parents[1]
+
+def migrate(source:Path, target:Path) -> Dict[str, int]:
+    if not Path(source).exists():
+        raise ValueError(f"Datastore not found: {source}")
+    backend = ParquetBackend(target)
+    migrated = {}
+    with pd.HDFStore(source, "r") as datastore:
+        for key in datastore.keys():
+            parts = key.strip("/").split("/")
+            df = datastore.select(key)
+            if len(parts) == 3 and parts[1] == "data":
+                # nodes written before the split_on column was stored get the group as split_on
+                if "split_on" not in df.columns:
+                    df["split_on"] = parts[2]
+                backend.write_data(parts[0], df, "split_on")
+            elif len(parts) == 2 and parts[1] in ("metadata", "errors", "metrics"):
+                backend.write_records(parts[0], parts[1], df)
+            elif len(parts) == 3 and parts[1] == "rollups":
+                if not df.empty:
+                    backend.replace_rollup(parts[0], parts[2], df, df["period"].min(), df["period"].max())
+            else:
+                continue
+            migrated[key] = len(df)
+    return migrated
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Copy the HDF5 datastore into the parquet backend")
+    parser.add_argument("--source", type=Path, default=ROOT.joinpath("data/processed/datastore.h5"))
+    parser.add_argument("--target", type=Path, default=ROOT.joinpath("data/processed/datastore"))
+    args = parser.parse_args()
+
+    migrated = migrate(args.source, args.target)
+    for key, rows in migrated.items():
+        print(f"{key}: {rows} rows")
+    print(f"{len(migrated)} nodes migrated to {args.target}")
@@ -0,0 +1,222 @@
+import shutil
+import time
+import pandas as pd
+from pathlib import Path
+from typing import List, Dict
+from uuid import uuid4
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.dataset as ds
+    import pyarrow.parquet as pq
+except ImportError: # pyarrow is only needed for the parquet backend
+    pa = None
+
+from datastore.lock import file_lock
+from pipelines.result import ClientResult
+
+class ParquetBackend:
+    # Stores the data as a hive partitioned parquet dataset:
+    # {root}/{client}/data/split_on={group}/date={YYYY-MM-DD}/part-{uuid}.parquet,
+    # {root}/{client}/{metadata,errors,metrics}/part-{uuid}.parquet and
+    # {root}/{client}/rollups/{name}/period_start={YYYY-MM-DD}/part-{time_ns}-{uuid}.parquet.
+    # Every data write creates new files and never touches existing ones, so several writers can store at the
+    # same time and readers are never blocked by a write. Only the rollup files of a period are replaced
+    PARTITIONING = ("split_on", "date")
+    READ_ATTEMPTS = 3 # a rollup read is repeated when a replace removed a file in the meantime
+
+    def __init__(self, root:Path, compression:str="zstd"):
+        if pa is None:
+            raise ValueError("The parquet backend requires the pyarrow package")
+        self.root = Path(root)
+        self.compression = compression
+        self._partitioning = ds.partitioning(pa.schema([(name, pa.string()) for name in ParquetBackend.PARTITIONING]), flavor="hive")
+
+    def exists(self) -> bool:
+        return self.root.exists()
+
+    def _write_table(self, directory:Path, df:pd.DataFrame) -> None:
+        directory.mkdir(parents=True, exist_ok=True)
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        # A column without any value (e.g. no alert for all earthquakes of a day) has no type of its own.
+        # It is stored as null type, which the readers promote to the type of the other files
+        for i, field in enumerate(table.schema):
+            if len(table) > 0 and table.column(i).null_count == len(table):
+                table = table.set_column(i, pa.field(field.name, pa.null()), pa.nulls(len(table)))
+        # write to a hidden file first, readers ignore files starting with "." until the rename
+        tmp_path = directory / f".part-{uuid4().hex}.parquet"
+        pq.write_table(table, tmp_path, compression=self.compression)
+        tmp_path.rename(directory / tmp_path.name[1:])
+
+    def _time_column(self, columns) -> str:
+        # weather and earthquakes have a timestamp column, the stocks are indexed by date
+        return "timestamp" if "timestamp" in columns else "index"
+
+    def write_data(self, client:str, df:pd.DataFrame, split_on:str) -> List[str]:
+        # the index is kept as a regular column, so the stocks can be filtered by date
+        df = df.reset_index(names="index")
+        time_column = df[self._time_column(df.columns)]
+        if pd.api.types.is_datetime64_any_dtype(time_column):
+            dates = time_column.dt.floor("D")
+        else:
+            dates = pd.Series(pd.NaT, index=df.index)
+        keys = set()
+        for (group, date), data in df.groupby([split_on, dates], sort=False, dropna=False):
+            date = "unknown" if pd.isna(date) else date.strftime("%Y-%m-%d")
+            directory = self.root / client / "data" / f"split_on={group}" / f"date={date}"
+            self._write_table(directory, data.drop(columns=split_on))
+            keys.add(f"/{client}/data/{group}")
+        return sorted(keys)
+
+    def write_records(self, client:str, kind:str, df:pd.DataFrame) -> str:
+        # metadata, errors and metrics
+        self._write_table(self.root / client / kind, df)
+        return f"/{client}/{kind}"
+
+    def write(self, client:str, result:ClientResult, split_on:str, bulk:bool=False, index_columns:List[str]|None=None) -> List[str]:
+        # every write is a bulk write, there are no indexes to maintain
+        keys = []
+        if result.data is not None and not result.data.empty:
+            keys.extend(self.write_data(client, result.data, split_on))
+        if result.metadata is not None and len(result.metadata) > 0:
+            keys.append(self.write_records(client, "metadata", pd.DataFrame(result.metadata)))
+        if result.errors is not None and len(result.errors) > 0:
+            keys.append(self.write_records(client, "errors", pd.DataFrame(result.errors)))
+        if result.metrics is not None and len(result.metrics) > 0:
+            keys.append(self.write_records(client, "metrics", pd.DataFrame(result.metrics)))
+        return keys
+
+    def _open(self, directory:Path, partitioning, files:List[Path]|None=None):
+        # all files of the directory, or only the given files with the partitions of their path below the directory
+        if files is not None and not files:
+            return None
+        source = directory if files is None else [str(path) for path in files]
+        options = {} if files is None else {"partition_base_dir": str(directory)}
+        dataset = ds.dataset(source, format="parquet", partitioning=partitioning, **options)
+        # the schema is unified over all files, the first file alone may have null or missing columns
+        schemas = [fragment.physical_schema for fragment in dataset.get_fragments()]
+        if not schemas:
+            return None
+        schema = pa.unify_schemas([*schemas, partitioning.schema], promote_options="default")
+        return ds.dataset(source, format="parquet", partitioning=partitioning, schema=schema, **options)
+
+    def _dataset(self, client:str):
+        directory = self.root / client / "data"
+        if not directory.exists():
+            return None
+        return self._open(directory, self._partitioning)
+
+    def groups(self, client:str) -> List[str]:
+        directory = self.root / client / "data"
+        if not directory.exists():
+            return []
+        return sorted(path.name.split("=", 1)[1] for path in directory.iterdir() if path.name.startswith("split_on="))
+
+    def read(self, client:str, groups:List[str], start_ts:pd.Timestamp|None, end_ts:pd.Timestamp|None,
+             columns:List[str]|None) -> Dict[str, pd.DataFrame]:
+        # The groups and the time range are pushed down as a dataset filter, the date partitions outside of
+        # the range are skipped without being opened. Only the requested columns are read
+        dataset = self._dataset(client)
+        if dataset is None or not groups:
+            return {}
+        time_column = self._time_column(dataset.schema.names)
+        condition = pc.field("split_on").isin(groups)
+        if start_ts is not None:
+            condition &= (pc.field("date") >= start_ts.strftime("%Y-%m-%d")) & (pc.field(time_column) >= start_ts.to_pydatetime())
+        if end_ts is not None:
+            condition &= (pc.field("date") <= end_ts.strftime("%Y-%m-%d")) & (pc.field(time_column) < end_ts.to_pydatetime())
+        if columns is not None:
+            columns = ["index", *[column for column in columns if column not in ("index", "split_on")], "split_on"]
+        else:
+            columns = [name for name in dataset.schema.names if name != "date"]
+        df = dataset.to_table(columns=columns, filter=condition).to_pandas()
+        df = df.set_index("index")
+        df.index.name = None
+        return {group: data for group, data in df.groupby("split_on", sort=False, observed=True)}
+
+    def read_columns(self, client:str, groups:List[str], columns:List[str]) -> Dict[str, pd.DataFrame]:
+        # Only the files of the group partitions are opened, all groups in one scan. Missing groups are left
+        # out, columns the files do not have are missing values
+        dataset = self._dataset(client)
+        if dataset is None or not groups:
+            return {}
+        present = [column for column in columns if column in dataset.schema.names]
+        df = dataset.to_table(columns=[*present, "split_on"], filter=pc.field("split_on").isin(groups)).to_pandas()
+        df = df.reindex(columns=[*columns, "split_on"])
+        if "index" in columns:
+            df = df.set_index("index")
+            df.index.name = None
+        return {group: data.drop(columns="split_on") for group, data in df.groupby("split_on", sort=False, observed=True)}
+
+    def rollups_locked(self, client:str):
+        # serializes the read, merge and replace of the rollups of a client, see DataStore.update_rollups
+        return file_lock(self.root / client / "rollups" / ".lock")
+
+    def _rollup_files(self, directory:Path) -> List[Path]:
+        # The newest file of every period. While a period is replaced the new file is already renamed and the
+        # old one not yet removed. Files named part-{uuid} were written before the time prefix and are older
+        files = []
+        for partition in directory.glob("period_start=*"):
+            names = [path.name for path in partition.glob("part-*.parquet")]
+            if names:
+                files.append(partition / max(names, key=lambda name: (name.count("-"), name)))
+        return files
+
+    def read_rollup(self, client:str, name:str, start_ts:pd.Timestamp|None=None, end_ts:pd.Timestamp|None=None) -> pd.DataFrame:
+        # rows of the periods starting in [start_ts, end_ts], the other period partitions are not opened
+        directory = self.root / client / "rollups" / name
+        partitioning = ds.partitioning(pa.schema([("period_start", pa.string())]), flavor="hive")
+        condition = None
+        if start_ts is not None:
+            condition = pc.field("period_start") >= start_ts.strftime("%Y-%m-%d")
+        if end_ts is not None:
+            upper = pc.field("period_start") <= end_ts.strftime("%Y-%m-%d")
+            condition = upper if condition is None else condition & upper
+        for attempt in range(ParquetBackend.READ_ATTEMPTS):
+            try:
+                dataset = self._open(directory, partitioning, self._rollup_files(directory)) if directory.exists() else None
+                if dataset is None:
+                    return pd.DataFrame()
+                columns = [column for column in dataset.schema.names if column != "period_start"]
+                return dataset.to_table(columns=columns, filter=condition).to_pandas()
+            except FileNotFoundError:
+                if attempt == ParquetBackend.READ_ATTEMPTS - 1:
+                    raise
+
+    def replace_rollup(self, client:str, name:str, df:pd.DataFrame, start_ts:pd.Timestamp, end_ts:pd.Timestamp) -> str:
+        # Every period has one file, which is replaced: the new file is written hidden and renamed, then the
+        # old files are removed. Readers take the newest file, a period is never missing or counted twice.
+        # Periods in [start_ts, end_ts] without rows are removed
+        directory = self.root / client / "rollups" / name
+        periods = {period.strftime("%Y-%m-%d"): data for period, data in df.groupby("period")}
+        if directory.exists():
+            for partition in directory.glob("period_start=*"):
+                period = partition.name.split("=", 1)[1]
+                if start_ts.strftime("%Y-%m-%d") <= period <= end_ts.strftime("%Y-%m-%d") and period not in periods:
+                    shutil.rmtree(partition)
+        for period, data in periods.items():
+            partition = directory / f"period_start={period}"
+            old_files = list(partition.glob("part-*.parquet"))
+            partition.mkdir(parents=True, exist_ok=True)
+            # the time prefix orders the files of a period
+            tmp_path = partition / f".part-{time.time_ns()}-{uuid4().hex}.parquet"
+            pq.write_table(pa.Table.from_pandas(data, preserve_index=False), tmp_path, compression=self.compression)
+            tmp_path.rename(partition / tmp_path.name[1:])
+            for path in old_files:
+                path.unlink()
+        return f"/{client}/rollups/{name}"
+
+    def remove_rollup(self, client:str, name:str) -> None:
+        directory = self.root / client / "rollups" / name
+        if directory.exists():
+            shutil.rmtree(directory)
+
+    def last_index(self, client:str) -> Dict[str, pd.Timestamp]:
+        dataset = self._dataset(client)
+        if dataset is None:
+            return {}
+        df = dataset.to_table(columns=["index", "split_on"]).to_pandas()
+        if not pd.api.types.is_datetime64_any_dtype(df["index"]):
+            return {}
+        return df.groupby("split_on", observed=True)["index"].max().to_dict()
@@ -0,0 +1,133 @@
+import argparse
+import numpy as np
+import pandas as pd
+from pathlib import Path
+from typing import Callable, Dict, List, Tuple
+
+# Aggregates of the stored time series per key (city, symbol, region) and period (day, week).
+# The rollup tables hold mergeable partial aggregates (sums and counts for means, the time of the first and
+# last value for open/close), so they are updated from the newly stored rows only: the aggregates of the new
+# rows are merged with the stored rows of the touched periods, which are then replaced.
+# usage: python -m datastore.rollups [weather stocks earthquake] [--store ...] [--backend hdf5]  (rebuilds the rollups)
+
+class Rollup:
+    # measures: output column -> (source column, aggregation), aggregation is one of
+    # count, sum, min, max, mean, first, last
+    AGGREGATIONS = ("count", "sum", "min", "max", "mean", "first", "last")
+
+    def __init__(self, name:str, key:str, time:str, freq:str, measures:Dict[str, Tuple[str, str]],
+                 key_function:Callable[[pd.DataFrame], pd.Series]|None=None) -> None:
+        for column, (_, aggregation) in measures.items():
+            if aggregation not in Rollup.AGGREGATIONS:
+                raise ValueError(f"Invalid aggregation for {column}: {aggregation}")
+        self.name = name
+        self.key = key
+        self.time = time # "index" for frames indexed by time
+        self.freq = freq # pandas period frequency, e.g. "D" or "W"
+        self.measures = measures
+        self.key_function = key_function # derives the key from the frame, e.g. the region of an earthquake
+
+    def partial(self, df:pd.DataFrame) -> pd.DataFrame:
+        # aggregates of new rows in the stored form
+        times = pd.Series(df.index if self.time == "index" else df[self.time].to_numpy())
+        keys = self.key_function(df) if self.key_function is not None else df[self.key]
+        frame = pd.DataFrame({self.key: np.asarray(keys),
+                              "period": times.dt.to_period(self.freq).dt.start_time.to_numpy(),
+                              "time": times.to_numpy()})
+        for column, _ in self.measures.values():
+            frame[column] = df[column].to_numpy()
+        frame = frame.dropna(subset=["period"])
+        grouped = frame.groupby([self.key, "period"], sort=False)
+        parts = {"rows": grouped.size()}
+        for output, (column, aggregation) in self.measures.items():
+            if aggregation == "mean":
+                parts[f"{output}_sum"] = grouped[column].sum()
+                parts[f"{output}_count"] = grouped[column].count()
+            elif aggregation in ("first", "last"):
+                positions = grouped["time"].idxmin() if aggregation == "first" else grouped["time"].idxmax()
+                parts[output] = pd.Series(frame.loc[positions.to_numpy(), column].to_numpy(), index=positions.index)
+                parts[f"{output}_time"] = pd.Series(frame.loc[positions.to_numpy(), "time"].to_numpy(), index=positions.index)
+            else:
+                parts[output] = grouped[column].agg(aggregation)
+        return pd.DataFrame(parts).reset_index()
+
+    def merge(self, partials:pd.DataFrame) -> pd.DataFrame:
+        # combines the stored form of several rows of the same key and period into one row
+        partials = partials.reset_index(drop=True)
+        grouped = partials.groupby([self.key, "period"], sort=False)
+        parts = {"rows": grouped["rows"].sum()}
+        for output, (_, aggregation) in self.measures.items():
+            if aggregation == "mean":
+                parts[f"{output}_sum"] = grouped[f"{output}_sum"].sum()
+                parts[f"{output}_count"] = grouped[f"{output}_count"].sum()
+            elif aggregation in ("first", "last"):
+                positions = grouped[f"{output}_time"].idxmin() if aggregation == "first" else grouped[f"{output}_time"].idxmax()
+                parts[output] = pd.Series(partials.loc[positions.to_numpy(), output].to_numpy(), index=positions.index)
+                parts[f"{output}_time"] = pd.Series(partials.loc[positions.to_numpy(), f"{output}_time"].to_numpy(), index=positions.index)
+            else:
+                # counts and sums add up, minima and maxima stay minima and maxima
+                parts[output] = grouped[output].agg({"count": "sum", "sum": "sum", "min": "min", "max": "max"}[aggregation])
+        return pd.DataFrame(parts).reset_index()
+
+    def finalize(self, stored:pd.DataFrame) -> pd.DataFrame:
+        # stored form -> the aggregates, one row per key and period
+        columns = [self.key, "period", "rows", *self.measures]
+        if stored.empty:
+            return pd.DataFrame(columns=columns)
+        df = self.merge(stored)
+        for output, (_, aggregation) in self.measures.items():
+            if aggregation == "mean":
+                df[output] = df[f"{output}_sum"] / df[f"{output}_count"].where(df[f"{output}_count"] > 0)
+        return df[columns].sort_values([self.key, "period"], kind="stable").reset_index(drop=True)
+
+def earthquake_region(df:pd.DataFrame) -> pd.Series:
+    # cells of 10 x 10 degrees, named by their south west corner, e.g. "lat30_lon130"
+    lat = (np.floor(df["lat"].to_numpy(dtype=float) / 10) * 10).astype(int)
+    lon = (np.floor(df["lon"].to_numpy(dtype=float) / 10) * 10).astype(int)
+    return pd.Series([f"lat{a}_lon{o}" for a, o in zip(lat, lon)], index=df.index)
+
+WEATHER_MEASURES = {"temperature_min": ("temperature", "min"),
+                    "temperature_max": ("temperature", "max"),
+                    "temperature_mean": ("temperature", "mean"),
+                    "humidity_mean": ("humidity", "mean")}
+STOCKS_MEASURES = {"open": ("open", "first"),
+                   "high": ("high", "max"),
+                   "low": ("low", "min"),
+                   "close": ("close", "last"),
+                   "volume": ("volume", "sum")}
+EARTHQUAKE_MEASURES = {"count": ("magnitude", "count"),
+                       "magnitude_max": ("magnitude", "max")}
+
+ROLLUPS = {"weather": [Rollup("daily", "city", "timestamp", "D", WEATHER_MEASURES),
+                       Rollup("weekly", "city", "timestamp", "W", WEATHER_MEASURES)],
+           "stocks": [Rollup("weekly", "symbol", "index", "W", STOCKS_MEASURES)],
+           "earthquake": [Rollup("daily", "region", "timestamp", "D", EARTHQUAKE_MEASURES, earthquake_region),
+                          Rollup("weekly", "region", "timestamp", "W", EARTHQUAKE_MEASURES, earthquake_region)]}
+
+def rebuild(datastore, clients:List[str]) -> Dict[str, int]:
+    # recomputes the rollups of existing data group by group, e.g. for stores written before the rollups existed
+    updated = {}
+    for client in clients:
+        with datastore.backend.rollups_locked(client):
+            for rollup in ROLLUPS.get(client, []):
+                datastore.backend.remove_rollup(client, rollup.name)
+        groups = datastore.backend.groups(client)
+        for group in groups:
+            datastore.update_rollups(client, datastore.query(client, [group]))
+        updated[client] = len(groups)
+    return updated
+
+if __name__ == "__main__":
+    from datastore.datastore import DataStore
+
+    parser = argparse.ArgumentParser(description="Rebuild the rollup tables from the stored data")
+    parser.add_argument("clients", nargs="*", help=f"any of {', '.join(ROLLUPS)}, defaults to all clients")
+    parser.add_argument("--store", type=Path, default=None, help="path of the datastore, defaults to data/processed/datastore.h5")
+    parser.add_argument("--backend", default="hdf5", help="storage backend, hdf5 or parquet")
+    args = parser.parse_args()
+    unknown = set(args.clients) - set(ROLLUPS)
+    if unknown:
+        parser.error(f"unknown clients: {', '.join(sorted(unknown))}")
+
+    for client, groups in rebuild(DataStore(args.store, backend=args.backend), args.clients or list(ROLLUPS)).items():
+        print(f"{client}: rollups rebuilt from {groups} groups")
@@ -0,0 +1,83 @@
+import os
+import pickle
+import time
+from pathlib import Path
+from typing import Dict, List, Tuple
+from uuid import uuid4
+
+from datastore.datastore import DataStore
+from datastore.lock import file_lock
+from pipelines.result import ClientResult
+
+DRAIN_ROWS = 100_000 # rows of the entries combined into one write by the drain
+
+class Spool:
+    # Write-ahead buffer in front of the datastore. HDF5 does not support concurrent writers, so the
+    # fetch tasks only put their results into the spool directory and a single writer drains it:
+    # every entry is one pickled (client, split_on, ClientResult) file, named by its arrival time
+    def __init__(self, directory:Path|None=None) -> None:
+        if directory is None:
+            directory = Path(__file__).resolve().parents[1].joinpath("data/spool")
+        self.directory = Path(directory)
+        self.lock_path = self.directory / ".drain.lock"
+
+    def put(self, client:str, result:ClientResult, split_on:str) -> Path:
+        if not client:
+            raise ValueError(f"Invalid name for client: {client}")
+        if not split_on:
+            raise ValueError(f"Invalid column name for splitting: {split_on}")
+        self.directory.mkdir(parents=True, exist_ok=True)
+        path = self.directory / f"{time.time_ns()}_{uuid4().hex[:8]}_{client}.pkl"
+        # written to a hidden file first, the drain only picks up complete entries
+        tmp_path = self.directory / f".{path.name}.tmp"
+        with tmp_path.open("wb") as output:
+            pickle.dump((client, split_on, result), output, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+        return path
+
+    def pending(self) -> List[Path]:
+        if not self.directory.exists():
+            return []
+        return sorted(self.directory.glob("[0-9]*.pkl"))
+
+    def locked(self):
+        # exclusive lock of the spool, held while draining it. The store itself has its own writer lock
+        return file_lock(self.lock_path)
+
+    def drain(self, datastore:DataStore|None=None, max_rows:int=DRAIN_ROWS) -> Dict[str, int]:
+        # Stores the pending entries with few bulk writes per client: the entries of a client are combined in
+        # arrival order until they hold max_rows rows, so streamed batches are never all loaded at once.
+        # The lock makes this process the only writer, a second drain waits until the first one is done and
+        # then finds an empty spool. An entry is only removed after its rows are in the store, a failed drain
+        # is simply repeated
+        datastore = datastore if datastore is not None else DataStore()
+        drained = {}
+        with self.locked():
+            # the client is the last part of the entry name, see put()
+            paths:Dict[str, List[Path]] = {}
+            for path in self.pending():
+                paths.setdefault(path.stem.split("_", 2)[2], []).append(path)
+
+            for client, client_paths in paths.items():
+                entries:List[Tuple[Path, ClientResult]] = []
+                rows = 0
+                split_on = None
+                for path in client_paths:
+                    with path.open("rb") as source:
+                        _, entry_split_on, result = pickle.load(source)
+                    if entries and (entry_split_on != split_on or rows >= max_rows):
+                        drained[client] = drained.get(client, 0) + self._store(datastore, client, split_on, entries)
+                        entries = []
+                        rows = 0
+                    split_on = entry_split_on
+                    entries.append((path, result))
+                    rows += len(result.data) if result.data is not None else 0
+                drained[client] = drained.get(client, 0) + self._store(datastore, client, split_on, entries)
+        return drained
+
+    def _store(self, datastore:DataStore, client:str, split_on:str, entries:List[Tuple[Path, ClientResult]]) -> int:
+        result = ClientResult.combine(result for _, result in entries)
+        datastore.store(client, result, split_on, bulk=True)
+        for path, _ in entries:
+            path.unlink()
+        return len(result.data) if result.data is not None else 0
@@ -0,0 +1,32 @@
+import json
+import os
+import pandas as pd
+from pathlib import Path
+from typing import Dict
+
+class WatermarkIndex:
+    # Persisted high-water marks (group -> last stored timestamp) of one client.
+    # Every client has its own small JSON file, so clients running in parallel never overwrite each other
+    def __init__(self, directory:Path, client:str) -> None:
+        self.path = Path(directory) / f"{client}.json"
+
+    def exists(self) -> bool:
+        return self.path.exists()
+
+    def load(self) -> Dict[str, pd.Timestamp]:
+        if not self.path.exists():
+            return {}
+        with self.path.open() as source:
+            return {group: pd.Timestamp(mark) for group, mark in json.load(source).items()}
+
+    def update(self, marks:Dict[str, pd.Timestamp]) -> None:
+        # a watermark only ever moves forward
+        watermarks = self.load()
+        for group, mark in marks.items():
+            if group not in watermarks or mark > watermarks[group]:
+                watermarks[group] = pd.Timestamp(mark)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_suffix(".tmp")
+        with tmp_path.open("w") as output:
+            json.dump({group: mark.isoformat() for group, mark in watermarks.items()}, output, indent=4)
+        os.replace(tmp_path, self.path)
@@ -0,0 +1,43 @@
+import argparse
+import sys
+from pathlib import Path
+
+from datastore.spool import Spool
+from pipelines.runner import CLIENTS, run
+
+# usage: python -m pipelines run [weather stocks earthquake] [--workers 3] [--processes] [--spool] [--stream]
+
+parser = argparse.ArgumentParser(prog="python -m pipelines", description="Run the API clients without Airflow")
+commands = parser.add_subparsers(dest="command", required=True)
+run_parser = commands.add_parser("run", help="fetch the clients concurrently and store the results")
+run_parser.add_argument("clients", nargs="*", help=f"any of {', '.join(CLIENTS)}, defaults to all clients")
+run_parser.add_argument("--workers", type=int, default=None, help="clients fetched at the same time, defaults to all")
+run_parser.add_argument("--processes", action="store_true", help="fetch in worker processes instead of threads")
+run_parser.add_argument("--store", type=Path, default=None, help="path of the datastore, defaults to data/processed/datastore.h5")
+run_parser.add_argument("--backend", default="hdf5", help="storage backend, hdf5 or parquet")
+run_parser.add_argument("--spool", action="store_true", help="only write the results into the spool for the drain task")
+run_parser.add_argument("--stream", action="store_true",
+                        help="store or spool the results batch by batch (pages, groups of cities) while the clients fetch")
+run_parser.add_argument("--trace-memory", action="store_true",
+                        help="measure the peak memory of every stage with tracemalloc, needs --processes for several clients")
+run_parser.add_argument("--prometheus", type=Path, default=None, help="write the stage metrics to this file in prometheus text format")
+args = parser.parse_args()
+
+unknown = set(args.clients) - set(CLIENTS)
+if unknown:
+    parser.error(f"unknown clients: {', '.join(sorted(unknown))}")
+if args.trace_memory and not args.processes and len(args.clients or CLIENTS) > 1:
+    parser.error("--trace-memory needs --processes when several clients are run")
+
+summary = run(args.clients or list(CLIENTS), args.store, args.backend, Spool() if args.spool else None, args.workers,
+              args.processes, args.trace_memory, args.prometheus, args.stream)
+for client, stats in summary.items():
+    if stats["error"] is not None:
+        print(f"{client}: failed: {stats['error']}")
+        continue
+    print(f"{client}: {stats['rows']} rows, {stats['errors']} errors")
+    for stage, measured in stats["stages"].items():
+        print(f"    {stage:8} {measured['seconds']:8.3f} s {measured['rows']:8} rows {measured['bytes'] / 2**20:8.2f} MB "
+              f"peak {measured['peak_memory_bytes'] / 2**20:8.1f} MB max rss {measured['max_rss_bytes'] / 2**20:8.1f} MB")
+if any(stats["error"] is not None for stats in summary.values()):
+    sys.exit(1)
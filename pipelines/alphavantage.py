@@ -1,19 +1,29 @@
 import requests
 import os
+import numpy as np
 import pandas as pd
-from pathlib import Path
 from dotenv import load_dotenv
-from typing import List, Dict, Tuple
+from typing import Dict, Iterator, List, Tuple
 from datetime import datetime
 
+from datastore.datastore import DataStore
+from datastore.watermarks import WatermarkIndex
+from pipelines.quota import DailyQuota
 from pipelines.result import ClientResult
 from utils.helpers import get_url, load_alpha_vantage_symbols, store
+from utils.http import create_session
+from utils.metrics import Metrics, timed
 
 load_dotenv("config/.env")
 
 class AlphaVantageClient:
+    NAME = "stocks" # name of the client in the datastore
+    SPLIT_ON = "split_on"
     # This API has a rate limit of 25 calls a day so be patient
-    def __init__(self) -> None:
+    COMPACT_SIZE = 100 # number of data points returned with outputsize=compact
+    DAILY_LIMIT = 25
+
+    def __init__(self, datastore:DataStore|None=None, calls_per_run:int|None=None) -> None:
         self.url = get_url("stocks")
         if self.url is None:
             # log error
@@ -25,27 +35,87 @@ class AlphaVantageClient:
                        "outputsize" : "compact",
                        "datatype" : "json",
                        "apikey" : self.apikey}
-        project_root = Path(__file__).resolve().parents[1]
-        self._datastore = project_root / "data" / "processed" / "datastore.h5"
+        self._datastore = datastore if datastore is not None else DataStore()
+        # The calls used today are persisted, so several runs a day share the quota.
+        # calls_per_run spreads the quota over the runs of a day, e.g. 12 symbols with 4 calls per run
+        # and one run a day -> every symbol is refreshed every 3 days
+        self.quota = DailyQuota(self._datastore.store_path.parent / "alphavantage_quota.json", AlphaVantageClient.DAILY_LIMIT)
+        self.calls_per_run = calls_per_run
+        # time of the last request per symbol, successful or not, so the schedule rotates through the symbols
+        self.attempts = WatermarkIndex(self._datastore.store_path.parent, "alphavantage_attempts")
+        self.session = create_session()
+        self.metrics = Metrics(AlphaVantageClient.NAME)
+        self.session.hooks["response"].append(self.metrics.count_response)
     
     def fetch(self) -> ClientResult:
+        # last stored date per symbol, this avoids opening the whole store
+        watermarks = self._datastore.get_watermarks("stocks")
         # get the stock data
-        response_stocks, metadata, errors = self._fetch_stocks()
-        df = self._process(response_stocks)
+        scheduled = self._schedule(watermarks)
+        response_stocks, metadata, errors = self._fetch_stocks(watermarks, scheduled)
+        df = self._process(response_stocks, watermarks)
         return ClientResult(data=df, metadata=metadata, errors=errors)
 
-    def _fetch_stocks(self) -> Tuple[List[Dict], List[Dict], List[Dict]]:
+    def stream(self) -> Iterator[ClientResult]:
+        # the few scheduled symbols of a run are small enough for one batch
+        yield self.fetch()
+
+    def _outputsize(self, watermark:pd.Timestamp|None) -> str:
+        # compact only returns the last 100 data points, if the gap since the last stored date is
+        # larger than that (or the symbol is new) the full series is requested
+        if watermark is None:
+            return "full"
+        missing_days = np.busday_count(watermark.date(), datetime.now().date())
+        return "compact" if missing_days < AlphaVantageClient.COMPACT_SIZE else "full"
+
+    def _schedule(self, watermarks:Dict[str, pd.Timestamp]) -> List[str]:
+        # The least recently requested symbols come first, so every symbol is refreshed once per
+        # len(symbols) / budget runs, also a symbol that always fails or whose data did not change
+        # (weekends, before the US close). Ties (e.g. nothing requested yet) go to never stored symbols,
+        # then to the oldest watermark, then to the order of the config file.
+        # Symbols beyond the budget are deferred to the next run
+        order = {symbol: position for position, symbol in enumerate(self.symbols)}
+        attempts = self.attempts.load()
+        by_staleness = sorted(self.symbols, key=lambda symbol: (attempts.get(symbol, pd.Timestamp.min),
+                                                                symbol in watermarks,
+                                                                watermarks.get(symbol, pd.Timestamp.min),
+                                                                order[symbol]))
+        budget = self.quota.remaining
+        if self.calls_per_run is not None:
+            budget = min(budget, self.calls_per_run)
+        return by_staleness[:budget]
+
+    def _quota_state(self, deferred_count:int) -> Dict:
+        return {"quota_used":self.quota.used,
+                "quota_limit":self.quota.limit,
+                "deferred_count":deferred_count}
+
+    def _fetch_stocks(self, watermarks:Dict[str, pd.Timestamp], scheduled:List[str]) -> Tuple[List[Dict], List[Dict], List[Dict]]:
         response_stocks = []
         metadata = []
         errors = []
-        for symbol in self.symbols:
-            self.params["symbol"] = symbol
+        attempted = []
+        for symbol in scheduled:
+            if self.quota.remaining == 0:
+                # the API reported the limit, the rest of the symbols is deferred
+                break
+            attempted.append(symbol)
+            params = {**self.params, "symbol": symbol, "outputsize": self._outputsize(watermarks.get(symbol))}
             response = None
             try:
-                response = requests.get(self.url, params=self.params, timeout=15)
+                response = self.session.get(self.url, params=params, timeout=15)
+                if not getattr(response, "from_cache", False) or getattr(response, "revalidated", False):
+                    # a response from the cache did not use a call of the quota, unless the API was asked again
+                    self.quota.record_call()
                 response.raise_for_status()
-                stocks = response.json().get("Time Series (Daily)")
+                payload = response.json()
+                stocks = payload.get("Time Series (Daily)")
                 if stocks is None:
+                    # the answer is not data, it must not be served from the cache
+                    self.session.response_cache.invalidate(response.url)
+                    if "Note" in payload or "Information" in payload:
+                        # the API answers with a note instead of data once the limit is reached
+                        self.quota.exhaust()
                     raise KeyError("Time Series (Daily)")
             except requests.HTTPError as e:
                 # log error
@@ -70,26 +140,25 @@ class AlphaVantageClient:
                                 "status":response.status_code if response else None,
                                 "success_count":len(response_stocks),
                                 "error_count":len(errors)})
+        if not metadata:
+            # nothing was fetched, still report the state of the quota
+            metadata.append({"fetched_at":datetime.now().isoformat(),
+                             "url":self.url,
+                             "status":None,
+                             "success_count":0,
+                             "error_count":len(errors)})
+        now = pd.Timestamp.now()
+        self.attempts.update({symbol: now for symbol in attempted})
+        for record in metadata:
+            record.update(self._quota_state(len(self.symbols) - len(attempted)))
         # store raw data
         store(response_stocks, "stocks")
         return response_stocks, metadata, errors
     
-    def _process(self, response_stocks:List[Dict]) -> pd.DataFrame:
-        # Here, distinguish between two cases
-        # 1. The first time storage occurs, we get the 100 days/data points from the API
-        # 2. From the 2nd API call on, we only want the last / most recent data point
-
-        if self._datastore.exists():
-            with pd.HDFStore(self._datastore, "r") as datastore:
-                keys = [
-                    key.split(r"/")[-1]
-                    for key in datastore.keys()
-                    if key.split(r"/")[1] == "stocks"
-                    and key.split(r"/")[2] == "data"
-                    ]
-        else:
-            keys = []
-        
+    @timed("process")
+    def _process(self, response_stocks:List[Dict], watermarks:Dict[str, pd.Timestamp]) -> pd.DataFrame:
+        # Only the data points newer than the last stored date of a symbol are kept.
+        # A new symbol keeps all data points, a skipped run is filled up with the missing days
         dfs = []
         for response in response_stocks: # list
             for symbol, data in response.items(): # of dictionaries
@@ -104,15 +173,10 @@ class AlphaVantageClient:
                 df["symbol"] = symbol
                 df["split_on"] = symbol
                 
-                if not keys:
-                    # data store does not exist yes, use all data point
-                    dfs.append(df)
-                elif symbol in keys:
-                    # data store exists and there is data for a symbol
-                    most_recent_data_point = pd.DataFrame(df.iloc[0,:]).T
-                    dfs.append(most_recent_data_point)
-                else:
-                    # the data store exists but no data for a symbol
+                watermark = watermarks.get(symbol)
+                if watermark is not None:
+                    df = df[df.index > watermark]
+                if not df.empty:
                     dfs.append(df)
         if not dfs:
             return pd.DataFrame(columns=["open", "high", "low", "close", "volume", "symbol", "split_on"])
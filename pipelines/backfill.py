@@ -0,0 +1,98 @@
+import argparse
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, List
+
+from datastore.datastore import DataStore
+from pipelines.result import ClientResult
+from pipelines.runner import CLIENTS
+from utils.archive import RawArchive
+
+# Rebuilds the datastore from the raw archive without any network access.
+# The archived responses go through the same transforms as a live run.
+# usage: python -m pipelines.backfill [weather stocks earthquake] [--workers 4] [--start 2025-08-01] [--end ...]
+
+API_NAMES = {"weather": "weather", "stocks": "stocks", "earthquake": "earthquakes"}
+CITY_TOLERANCE = 0.01 # in degrees, the weather API echoes the requested coordinates rounded to 4 decimals
+
+_clients = {}
+
+def _client(client:str):
+    # one client per worker process
+    if client not in _clients:
+        _clients[client] = CLIENTS[client]()
+    return _clients[client]
+
+def _weather_frame(raw_data:List[Dict]) -> pd.DataFrame:
+    # the weather responses do not contain the configured city, it is matched by the coordinates
+    client = _client("weather")
+    df_geolocations = pd.DataFrame(client.geocoding_cache.rows(client.locations), columns=["city", "country", "lon", "lat"])
+    if not raw_data:
+        return pd.DataFrame()
+    if df_geolocations.empty:
+        # The API only names the district of the coordinates (e.g. "Alt-Kölln" for Berlin), without the
+        # cached coordinates the responses cannot be matched to the cities without a network access
+        raise ValueError(f"No city coordinates in {client.geocoding_cache.cache_path}, run the weather client "
+                         "once to geocode the cities before the backfill")
+    coordinates = np.array([[response["coord"]["lon"], response["coord"]["lat"]] for response in raw_data])
+    distances = np.abs(coordinates[:, None, :] - df_geolocations[["lon", "lat"]].to_numpy()[None, :, :]).max(axis=2)
+    nearest = distances.argmin(axis=1)
+    matched = distances[np.arange(len(nearest)), nearest] <= CITY_TOLERANCE
+    df_matched = df_geolocations.iloc[nearest[matched]]
+    responses = [response for response, is_matched in zip(raw_data, matched) if is_matched]
+    df_weather = client._process_weather_responses(responses, list(zip(df_matched["city"], df_matched["country"])))
+    return client._process(df_geolocations, df_weather)
+
+def _stocks_frame(raw_data:List[Dict]) -> pd.DataFrame:
+    # without watermarks every archived data point is kept, already stored ones are dropped later
+    return _client("stocks")._process(raw_data, {})
+
+def _earthquake_frame(raw_data:Dict) -> pd.DataFrame:
+    client = _client("earthquake")
+    return client._to_dataframe(client._process(raw_data))
+
+TRANSFORMS = {"weather": _weather_frame, "stocks": _stocks_frame, "earthquake": _earthquake_frame}
+
+def transform_file(client:str, path:Path, start:datetime|None=None, end:datetime|None=None) -> pd.DataFrame:
+    archive = RawArchive(API_NAMES[client])
+    frames = [TRANSFORMS[client](raw_data) for _, raw_data in archive.read(path, start, end)]
+    frames = [frame for frame in frames if not frame.empty]
+    return pd.concat(frames) if frames else pd.DataFrame()
+
+def backfill(clients:List[str], datastore:DataStore|None=None, workers:int|None=None,
+             start:datetime|None=None, end:datetime|None=None) -> Dict[str, int]:
+    datastore = datastore if datastore is not None else DataStore()
+    stored_rows = {}
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for client in clients:
+            paths = RawArchive(API_NAMES[client]).files()
+            frames = [frame for frame in executor.map(transform_file, [client] * len(paths), paths,
+                                                      [start] * len(paths), [end] * len(paths))
+                      if not frame.empty]
+            if not frames:
+                stored_rows[client] = 0
+                continue
+            # the datastore skips the rows that are already stored, so a backfill can be repeated
+            result = ClientResult(data=pd.concat(frames), metadata=None, errors=None)
+            stored_rows[client] = datastore.store(client, result, "split_on", bulk=True)
+    return stored_rows
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Rebuild the datastore from the raw archive")
+    parser.add_argument("clients", nargs="*", help=f"any of {', '.join(API_NAMES)}, defaults to all clients")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--start", type=datetime.fromisoformat, default=None)
+    parser.add_argument("--end", type=datetime.fromisoformat, default=None)
+    parser.add_argument("--store", type=Path, default=None, help="path of the datastore, defaults to data/processed/datastore.h5")
+    parser.add_argument("--backend", default="hdf5", help="storage backend, hdf5 or parquet")
+    args = parser.parse_args()
+    unknown = set(args.clients) - set(API_NAMES)
+    if unknown:
+        parser.error(f"unknown clients: {', '.join(sorted(unknown))}")
+
+    stored = backfill(args.clients or list(API_NAMES), DataStore(args.store, backend=args.backend), args.workers, args.start, args.end)
+    for client, rows in stored.items():
+        print(f"{client}: {rows} new rows")
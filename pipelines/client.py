@@ -0,0 +1,20 @@
+import requests
+from typing import Iterator, Protocol, runtime_checkable
+
+from pipelines.result import ClientResult
+from utils.metrics import Metrics
+
+@runtime_checkable
+class Client(Protocol):
+    # What the runner and the benchmark need from an API client
+    NAME: str # name of the client in the datastore
+    SPLIT_ON: str # column of the data that splits it into the nodes of the datastore
+    metrics: Metrics # stage measurements, the runner adds the fetch stage
+    session: requests.Session # pooled session of all requests, counted by a response hook of the metrics
+
+    def fetch(self) -> ClientResult:
+        ...
+
+    def stream(self) -> Iterator[ClientResult]:
+        # the same data as fetch() in batches, e.g. pages or groups of cities, to be stored one by one
+        ...
@@ -1,13 +1,20 @@
 import requests
+import numpy as np
 import pandas as pd
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 from datetime import datetime, timedelta
+from itertools import islice
 from zoneinfo import ZoneInfo
-from typing import List, Dict
+from typing import Dict, Iterator, Tuple
 
 from pipelines.result import ClientResult
 from utils.helpers import store, get_url
+from utils.http import create_session
+from utils.metrics import Metrics, frame_bytes
 
 class EarthQuakeClient:
+    NAME = "earthquake" # name of the client in the datastore
+    SPLIT_ON = "split_on"
 
     MAGNITUDE_TYPE_DESCRIPTION = {"Mw": "Moment Magnitude",
                                   "Ms": "Surface Wave Magnitude",
@@ -25,83 +32,123 @@ class EarthQuakeClient:
                                   "MwB": "Body-wave Derived Moment Magnitude",
                                   "mww": "Moment Magnitude from W-phase"}
 
-    def __init__(self) -> None:
+    PAGE_SIZE = 20000 # maximum number of events the API returns per request
+
+    def __init__(self, page_size:int=PAGE_SIZE, max_workers:int=4) -> None:
         self.url = get_url("earthquake")
         self.params = {"method" : "query",
                        "format" : "geojson",
-                       "limit" : 100, # Define a limit of 100 eathquakes a day
+                       "limit" : page_size, # events per page, the pages are requested until a window is complete
+                       "offset" : 1, # the offset of the API starts at 1
                        "starttime": None,
                        "endtime" : None,
                        "orderby" : "time"}
         # Ensure that the requests ate performed witih the timezone for germany
         self.berlin_time = ZoneInfo("Europe/Berlin")
+        self.page_size = page_size
+        self.max_workers = max(1, max_workers)
+        self.session = create_session(pool_maxsize=self.max_workers)
+        self.metrics = Metrics(EarthQuakeClient.NAME)
+        self.session.hooks["response"].append(self.metrics.count_response)
 
     def fetch(self) -> ClientResult:
-        # Get the data from teh last 24 hrs. Use time in germany
-        today = datetime.now(self.berlin_time).replace(microsecond=0)
-        yesterday = today - timedelta(days=1)
-        self.params["starttime"] = yesterday.isoformat()
-        self.params["endtime"] = today.isoformat()
+        return ClientResult.combine(self.stream())
+
+    def stream(self, starttime:datetime|None=None, endtime:datetime|None=None, window:timedelta=timedelta(days=1)) -> Iterator[ClientResult]:
+        # Yields the events of the period page by page, by default the last 24 hrs in the time of germany.
+        # The period is split into windows which are fetched concurrently. A full page means that the
+        # window has more events, so the next page of that window is requested with a larger offset.
+        # At most max_workers pages are in flight, results are yielded as soon as a page is processed,
+        # so a long backfill only holds a few pages in memory
+        if endtime is None:
+            endtime = datetime.now(self.berlin_time).replace(microsecond=0)
+        if starttime is None:
+            starttime = endtime - timedelta(days=1)
+        windows = []
+        window_start = starttime
+        while window_start < endtime:
+            windows.append((window_start, min(window_start + window, endtime)))
+            window_start += window
+        pending = iter(windows)
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            in_flight = {}
+            for window_start, window_end in islice(pending, self.max_workers):
+                in_flight[executor.submit(self._fetch_page, window_start, window_end, 1)] = (window_start, window_end, 1)
+            while in_flight:
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    window_start, window_end, offset = in_flight.pop(future)
+                    result, page_full = future.result()
+                    if page_full:
+                        next_page = (window_start, window_end, offset + self.page_size)
+                    else:
+                        next_page = next(((start, end, 1) for start, end in pending), None)
+                    if next_page is not None:
+                        in_flight[executor.submit(self._fetch_page, *next_page)] = next_page
+                    yield result
+
+    def _fetch_page(self, starttime:datetime, endtime:datetime, offset:int) -> Tuple[ClientResult, bool]:
+        params = {**self.params, "starttime": starttime.isoformat(), "endtime": endtime.isoformat(), "offset": offset}
         errors = []
         metadata = []
         response = None
+        page_full = False
         try:
-            response = requests.get(self.url, params=self.params)
+            response = self.session.get(self.url, params=params, timeout=60)
             response.raise_for_status()
         except requests.HTTPError as e:
             errors.append({"timestamp":datetime.now().isoformat(),
-                           "url":response.url if response else self.url,
+                           "url":response.url if response is not None else self.url,
                            "error":str(e),
                            "current_symbol":"",
-                           "status":response.status_code if response else None})
+                           "status":response.status_code if response is not None else None})
             df = pd.DataFrame(columns=["timestamp", "magnitude", "scale", "alert", "tsunami", "place", "coordinates"])
         else:
             raw_data = response.json()
-            records = self._process(raw_data)
+            with self.metrics.stage("process") as record:
+                df = self._to_dataframe(self._process(raw_data))
+                record["rows"] = len(df)
+                record["bytes"] = frame_bytes(df)
             # store raw data in the data/raw directory
             store(raw_data, "earthquakes")
-            df = self._to_dataframe(records)
+            page_full = len(raw_data["features"]) >= self.page_size
             metadata.append({"fetched_at":datetime.now().isoformat(),
-                             "url":response.url if response else self.url,
-                             "status":response.status_code if response else None,
+                             "url":response.url,
+                             "status":response.status_code,
                              "success_count":len(raw_data["features"]),
                              "error_count":len(errors)})
-        return ClientResult(data=df, metadata=metadata, errors=errors)
+        return ClientResult(data=df, metadata=metadata, errors=errors), page_full
 
-    def _process(self, response:Dict) -> Dict[str,List]:
+    def _process(self, response:Dict) -> pd.DataFrame:
         # helps process the requested data before creating the data frame
-        # The kekys match the keys return by the API for better processing
-        records = {"time":[],
-                   "mag":[],
-                   "magType":[],
-                   "alert":[],
-                   "tsunami":[],
-                   "place":[],
-                   "coordinates":[]}
+        # The columns match the keys return by the API for better processing
+        features = response["features"]
         # the response contains the information about the earthquakes under the features key
-        for earthquake in response["features"]:
-            # Using the keys of the records dict get the values from each earthquake
-            for feature in records:
-                if feature in earthquake["properties"]:
-                    records[feature].append(earthquake["properties"][feature])
-                # The coordinates of the earthquake are located under the "geometry" key of the response
-                else:
-                    records[feature].append(earthquake["geometry"][feature])
+        records = pd.DataFrame.from_records([earthquake["properties"] for earthquake in features],
+                                            columns=["time", "mag", "magType", "alert", "tsunami", "place"])
+        # The coordinates of the earthquake are located under the "geometry" key of the response
+        # longitude, latitude and depth are split in one go as columns of a numpy array
+        coordinates = np.array([earthquake["geometry"]["coordinates"] for earthquake in features], dtype="float64").reshape(-1, 3)
+        records["lon"] = coordinates[:, 0]
+        records["lat"] = coordinates[:, 1]
+        records["depth"] = coordinates[:, 2]
+        # the event id of USGS stays the same when the event is revised
+        records["id"] = [earthquake["id"] for earthquake in features]
         return records
         
-    def _to_dataframe(self, records:Dict) -> pd.DataFrame:
-        # converts data into geodataframe
-        df = pd.DataFrame(records)
-        # separte longitude and latitude from the depth
-        df["lon"] = df.coordinates.apply(lambda coord: coord[0])
-        df["lat"] = df.coordinates.apply(lambda coord: coord[1])
-        df["depth"] = df.coordinates.apply(lambda coord: coord[2])
-        df = df.drop("coordinates", axis=1)
+    def _to_dataframe(self, records:pd.DataFrame) -> pd.DataFrame:
         # rename columns for better understanding
-        df = df.rename(columns={"time":"timestamp", "mag":"magnitude", "magType":"scale"})
-        df = df.replace(EarthQuakeClient.MAGNITUDE_TYPE_DESCRIPTION)       
+        df = records.rename(columns={"time":"timestamp", "mag":"magnitude", "magType":"scale"})
+        # only the few distinct magnitude types are looked up, not every row.
+        # Missing types have the code -1 and pick the trailing None
+        scale = df["scale"].astype("category")
+        descriptions = np.array([EarthQuakeClient.MAGNITUDE_TYPE_DESCRIPTION.get(magnitude_type, magnitude_type)
+                                 for magnitude_type in scale.cat.categories] + [None], dtype=object)
+        df["scale"] = descriptions[scale.cat.codes.to_numpy()]
         df["timestamp"] = pd.to_datetime(df["timestamp"], unit="ms") # Timestamps in the responses are in ms
-        df["split_on"] = df["timestamp"].dt.strftime("date_%Y_%m_%d")
+        # the node name is formatted once per day instead of once per earthquake
+        codes, days = pd.factorize(df["timestamp"].dt.floor("D"))
+        df["split_on"] = days.strftime("date_%Y_%m_%d").to_numpy(dtype=object)[codes]
         return df
     
 if __name__ == "__main__":
@@ -1,27 +1,40 @@
 import requests
 import os
 import pandas as pd
-import time
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 from datetime import datetime
 from zoneinfo import ZoneInfo
-from typing import List, Dict, Tuple
+from typing import Dict, Iterator, List, Tuple
 
 from pipelines.result import ClientResult
-from utils.helpers import get_url, load_openweather_cities, store
+from utils.helpers import get_url, load_openweather_locations, store
+from utils.http import create_session
+from utils.geocoding_cache import GeocodingCache
+from utils.metrics import Metrics, timed
+from utils.ratelimit import TokenBucket
 
 load_dotenv("config/.env")
 
 class OpeanWeatherClient:
+    NAME = "weather" # name of the client in the datastore
+    SPLIT_ON = "split_on"
+    BATCH_SIZE = 500 # cities per batch in the streaming mode
 
-    def __init__(self) -> None:
+    def __init__(self, max_workers:int=4, requests_per_second:float=1.0, burst:int=60, refresh_geocoding:bool=False) -> None:
         self.url_geocoding = get_url("geocoding")
         self.url_weather = get_url("weather")
         if self.url_geocoding is None or self.url_weather is None:
             # log error
             raise ValueError("URL not found in source.csv")
         self.apikey = os.getenv("OPENWEATHER_API_KEY")
-        self.cities = load_openweather_cities()
+        self.locations = load_openweather_locations()
+        self.cities = [city for city, _ in self.locations]
+        # coordinates never change, only new or changed cities are sent to the geocoding API
+        self.geocoding_cache = GeocodingCache()
+        if refresh_geocoding:
+            for city, country in self.locations:
+                self.geocoding_cache.invalidate(city, country)
         self.params_geocoding = {"q": None, "limit" : 1, "appid" : self.apikey}
         self.params_weather = params = {"units":"metric",
                                         "lon" : None,
@@ -30,101 +43,165 @@ class OpeanWeatherClient:
                                         "appid" : self.apikey}
         # Ensure that the requests are performed with the timezone for germany
         self.berlin_time = ZoneInfo("Europe/Berlin")
+        # Requests are sent concurrently by a bounded pool of threads sharing one pooled session.
+        # The token bucket replaces the fixed sleep, there is a request limit for the OpenWeather API
+        # (60 calls per minute -> bursts of 60 requests, then one request per second)
+        self.max_workers = max(1, max_workers)
+        self.rate_limiter = TokenBucket(requests_per_second, capacity=burst)
+        self.session = create_session(pool_maxsize=self.max_workers)
+        self.metrics = Metrics(OpeanWeatherClient.NAME)
+        self.session.hooks["response"].append(self.metrics.count_response)
 
     def fetch(self) -> ClientResult:
+        return self._fetch_batch(self.locations)
+
+    def stream(self, batch_size:int=BATCH_SIZE) -> Iterator[ClientResult]:
+        # Yields the cities batch by batch, fetched and transformed. Only the responses of one batch are held
+        # in memory, so the memory stays flat for long city lists when the caller stores every batch
+        for start in range(0, len(self.locations), batch_size):
+            yield self._fetch_batch(self.locations[start:start + batch_size])
+
+    def _fetch_batch(self, locations:List[Tuple[str, str]]) -> ClientResult:
         errors = []
         metadata_list = []
         # get the responses with cities data
-        city_responses, metadata_geocoding, errors_geocoding = self._fetch_city_geocoding()
+        city_responses, metadata_geocoding, errors_geocoding = self._fetch_city_geocoding(locations)
         # record erros from the cities
         errors.extend(errors_geocoding)
         metadata_list.extend(metadata_geocoding)
         # process city responses
-        df_geolocations = self._process_city_responses(city_responses)        
+        df_geolocations = self._process_city_responses(city_responses, locations)
         # get weather responses for each city
-        weather_responses, metadata_weather, errors_weather = self._fetch_weather(df_geolocations)
+        weather_responses, weather_locations, metadata_weather, errors_weather = self._fetch_weather(df_geolocations)
         errors.extend(errors_weather)
         metadata_list.extend(metadata_weather)
         # process weather responses
-        df_weather = self._process_weather_responses(weather_responses)
+        df_weather = self._process_weather_responses(weather_responses, weather_locations)
         df = self._process(df_geolocations, df_weather)
         return ClientResult(data=df, metadata=metadata_list, errors=errors)
     
+    @timed("process")
     def _process(self, df_geolocations:pd.DataFrame, df_weather:pd.DataFrame) -> pd.DataFrame:
-        df = pd.concat([df_geolocations, df_weather], axis=1)
+        # joined by the city, a city without a weather response (e.g. a failed request) has no row
+        df = df_geolocations.merge(df_weather, on=["city", "country"], how="inner")
         df = df.drop(["name"], axis=1)
         df["split_on"] = df["city"] # This column is used by the DataStore class to store the data according to the datamodel
         return df
     
-    def _fetch_city_geocoding(self) -> Tuple[List[Dict], List[Dict], List[Dict]]:
+    def _get(self, url:str, params:Dict) -> requests.Response:
+        # every request, no matter from which thread, has to take a token first
+        self.rate_limiter.acquire()
+        return self.session.get(url, params=params, timeout=15)
+
+    def _get_or_error(self, url:str, params:Dict) -> requests.Response|requests.RequestException:
+        # a timeout or connection error of one city is returned instead of raised,
+        # otherwise it would discard the responses of all other cities
+        try:
+            return self._get(url, params)
+        except requests.RequestException as e:
+            return e
+
+    def _fetch_concurrently(self, url:str, params_list:List[Dict]) -> List[requests.Response|requests.RequestException]:
+        # the order of the responses matches the order of params_list
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            return list(executor.map(lambda params: self._get_or_error(url, params), params_list))
+
+    def _error(self, url:str, city:str, e:requests.RequestException) -> Dict:
+        # failed requests have no response, e.g. a timeout
+        response = e.response
+        return {"timestamp":datetime.now().isoformat(),
+                "url":response.url if response is not None else url,
+                "error":str(e),
+                "current_symbol":city,
+                "status":response.status_code if response is not None else None}
+
+    def _fetch_city_geocoding(self, locations:List[Tuple[str, str]]) -> Tuple[List[Dict], List[Dict], List[Dict]]:
         errors = []
         metadata = []
         response_cities = []
-        for city in self.cities:
-            self.params_geocoding["q"] = city
+        response = None
+        missing = [city for city, country in locations if self.geocoding_cache.get(city, country) is None]
+        params_list = [{**self.params_geocoding, "q": city} for city in missing]
+        responses = self._fetch_concurrently(self.url_geocoding, params_list)
+        for city, outcome in zip(missing, responses):
             try:
-                response = requests.get(self.url_geocoding, params=self.params_geocoding)
+                if isinstance(outcome, requests.RequestException):
+                    raise outcome
+                response = outcome
                 response.raise_for_status()
-            except requests.HTTPError as e:
-                errors.append({"timestamp":datetime.now().isoformat(), "url":response.url, "error":str(e), "current_symbol":city, "status":response.status_code})
+            except requests.RequestException as e:
+                errors.append(self._error(self.url_geocoding, city, e))
             else:
-                response_cities.append(response.json())
-                time.sleep(1) # There is a request limit for the OpenWeather API
-        metadata.append({"fetched_at":datetime.now().isoformat(), "url":response.url, "status":response.status_code, "success_count":len(response_cities), "error_count":len(errors)})
+                response_cities.append({city:response.json()})
+        metadata.append({"fetched_at":datetime.now().isoformat(),
+                         "url":response.url if response is not None else self.url_geocoding,
+                         "status":response.status_code if response is not None else None,
+                         "success_count":len(response_cities),
+                         "error_count":len(errors)})
         return response_cities, metadata, errors
     
-    def _process_city_responses(self, city_responses:List[Dict]) -> pd.DataFrame:
-        city_coordinates = []
-        for response_list in city_responses:
-            for response in response_list:
-                row = {"city" : response["name"],
-                       "country" : response["country"],
-                       "lon" : response["lon"],
-                       "lat" : response["lat"]}
-                city_coordinates.append(row)
-        df_geolocations = pd.DataFrame(city_coordinates) # latitude an longitude in EPSG:4326
-        df_geolocations = df_geolocations.replace(dict(zip(df_geolocations["city"].tolist(), self.cities)))
-        return df_geolocations
+    @timed("process", count_rows=False)
+    def _process_city_responses(self, city_responses:List[Dict], locations:List[Tuple[str, str]]) -> pd.DataFrame:
+        # new geocoding results go into the cache, the frame itself is always built from the cache
+        countries = dict(locations)
+        for response in city_responses:
+            for city, response_list in response.items():
+                if response_list:
+                    self.geocoding_cache.put(city, countries[city], response_list[0]["lon"], response_list[0]["lat"])
+        self.geocoding_cache.save()
+        city_coordinates = self.geocoding_cache.rows(locations)
+        # latitude an longitude in EPSG:4326
+        return pd.DataFrame(city_coordinates, columns=["city", "country", "lon", "lat"])
     
-    def _fetch_weather(self, df_geolocations:pd.DataFrame) -> Tuple[List[Dict], List[Dict], List[Dict]]:
+    def _fetch_weather(self, df_geolocations:pd.DataFrame) -> Tuple[List[Dict], List[Tuple[str, str]], List[Dict], List[Dict]]:
+        # the responses come with the (city, country) they were requested for
         errors = []
         metadata = []
         responses_weather = []
+        locations_weather = []
+        response = None
         now = datetime.now(self.berlin_time).replace(microsecond=0)
-        for _, record in df_geolocations.iterrows():
-            lon = record["lon"]
-            lat = record["lat"]
-            self.params_weather["lon"] = lon
-            self.params_weather["lat"] = lat
-            self.params_weather["date"] = now.isoformat()
+        params_list = [{**self.params_weather, "lon": lon, "lat": lat, "date": now.isoformat()}
+                       for lon, lat in zip(df_geolocations["lon"], df_geolocations["lat"])]
+        responses = self._fetch_concurrently(self.url_weather, params_list)
+        for city, country, outcome in zip(df_geolocations["city"], df_geolocations["country"], responses):
             try:
-                response = requests.get(self.url_weather, params=self.params_weather)
+                if isinstance(outcome, requests.RequestException):
+                    raise outcome
+                response = outcome
                 response.raise_for_status()
-            except requests.HTTPError as e:
+            except requests.RequestException as e:
                 # log error
-                errors.append({"timestamp":datetime.now().isoformat(), "url":response.url, "error":str(e), "current_symbol":record["city"], "status":response.status_code})
+                errors.append(self._error(self.url_weather, city, e))
             else:
                 responses_weather.append(response.json())
+                locations_weather.append((city, country))
         # Store raw data for the examples
-        metadata.append({"fetched_at":datetime.now().isoformat(), "url":response.url, "status":response.status_code, "success_count":len(responses_weather), "error_count":len(errors)})
+        metadata.append({"fetched_at":datetime.now().isoformat(),
+                         "url":response.url if response is not None else self.url_weather,
+                         "status":response.status_code if response is not None else None,
+                         "success_count":len(responses_weather),
+                         "error_count":len(errors)})
         store(responses_weather, "weather")
-        return responses_weather, metadata, errors
+        return responses_weather, locations_weather, metadata, errors
             
-    def _process_weather_responses(self, weather_respones:List[Dict]) -> pd.DataFrame:
-        weather = []
-        for response in weather_respones:
-            row = {"name" : response["name"], # city name - it might not match no automatic geocoding by the API
-                   "temperature" : response["main"]["temp"], # Temperature
-                   "temperature_max" : response["main"]["temp_max"], # Max temp at the moment
-                   "temperature_min" : response["main"]["temp_min"], # Min temp at the moment
-                   "feels_like" : response["main"]["feels_like"], # Human perception of the weather
-                   "humidity" : response["main"]["humidity"], # in %
-                   "wind_speed" : response["wind"]["speed"], # in m/s
-                   "wind_direction" : response["wind"]["deg"],
-                   "description" : response["weather"][0]["description"],
-                   "timestamp" : pd.to_datetime(response["dt"], unit="s")}
-            weather.append(row)
-        return pd.DataFrame(weather)
+    @timed("process", count_rows=False)
+    def _process_weather_responses(self, weather_respones:List[Dict], locations:List[Tuple[str, str]]) -> pd.DataFrame:
+        # built column by column, locations holds the (city, country) of every response
+        main = [response["main"] for response in weather_respones]
+        wind = [response["wind"] for response in weather_respones]
+        return pd.DataFrame({"city" : [city for city, _ in locations],
+                             "country" : [country for _, country in locations],
+                             "name" : [response["name"] for response in weather_respones], # city name - it might not match no automatic geocoding by the API
+                             "temperature" : [values["temp"] for values in main], # Temperature
+                             "temperature_max" : [values["temp_max"] for values in main], # Max temp at the moment
+                             "temperature_min" : [values["temp_min"] for values in main], # Min temp at the moment
+                             "feels_like" : [values["feels_like"] for values in main], # Human perception of the weather
+                             "humidity" : [values["humidity"] for values in main], # in %
+                             "wind_speed" : [values["speed"] for values in wind], # in m/s
+                             "wind_direction" : [values["deg"] for values in wind],
+                             "description" : [response["weather"][0]["description"] for response in weather_respones],
+                             "timestamp" : pd.to_datetime([response["dt"] for response in weather_respones], unit="s")})
 
 if __name__ == "__main__":
     # quick tests
@@ -134,5 +211,6 @@ if __name__ == "__main__":
     weather = client.fetch()
     project_root = Path(__file__).resolve().parents[1]
     output_path = project_root / "data" / "raw" / "weather" / "weather_test.csv"
-    weather.to_csv(output_path, index=False)
+    if weather.data is not None:
+        weather.data.to_csv(output_path, index=False)
     
\ No newline at end of file
@@ -0,0 +1,49 @@
+import json
+import os
+from datetime import datetime, timezone
+from pathlib import Path
+
+class DailyQuota:
+    # Persisted counter of the API calls used per day, shared by every run of a client.
+    # The counter starts over when the (UTC) date changes
+    def __init__(self, path:Path, limit:int) -> None:
+        self.path = Path(path)
+        self.limit = limit
+        self.date, self.used = self._load()
+
+    def _today(self) -> str:
+        return datetime.now(timezone.utc).date().isoformat()
+
+    def _load(self) -> tuple[str, int]:
+        today = self._today()
+        if not self.path.exists():
+            return today, 0
+        with self.path.open() as source:
+            state = json.load(source)
+        if state.get("date") != today:
+            return today, 0
+        return today, int(state.get("used", 0))
+
+    def _save(self) -> None:
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_suffix(".tmp")
+        with tmp_path.open("w") as output:
+            json.dump({"date": self.date, "used": self.used, "limit": self.limit}, output, indent=4)
+        os.replace(tmp_path, self.path)
+
+    @property
+    def remaining(self) -> int:
+        if self.date != self._today():
+            # a run across midnight gets the new day's quota
+            self.date, self.used = self._today(), 0
+        return max(0, self.limit - self.used)
+
+    def record_call(self) -> None:
+        self.remaining # roll over the date if needed
+        self.used += 1
+        self._save()
+
+    def exhaust(self) -> None:
+        # the API reported that the limit was reached, no more calls today
+        self.used = max(self.used, self.limit)
+        self._save()
@@ -1,9 +1,23 @@
 from dataclasses import dataclass
 import pandas as pd
-from typing import List, Dict, Optional
+from typing import List, Dict, Iterable, Optional
 
 @dataclass
 class ClientResult:
     data: Optional[pd.DataFrame]
     metadata: Optional[List[Dict]]
     errors: Optional[List[Dict]]
+    metrics: Optional[List[Dict]] = None # stage records of utils.metrics, stored apart from the metadata
+
+    @classmethod
+    def combine(cls, results:Iterable["ClientResult"]) -> "ClientResult":
+        # merges the results of several pages/batches into one
+        frames, metadata, errors, metrics = [], [], [], []
+        for result in results:
+            if result.data is not None and not result.data.empty:
+                frames.append(result.data)
+            metadata.extend(result.metadata or [])
+            errors.extend(result.errors or [])
+            metrics.extend(result.metrics or [])
+        data = pd.concat(frames) if frames else None
+        return cls(data=data, metadata=metadata, errors=errors, metrics=metrics)
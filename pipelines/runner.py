@@ -0,0 +1,152 @@
+import queue
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from contextlib import ExitStack
+from multiprocessing import Manager
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+from datastore.datastore import DataStore
+from datastore.spool import Spool
+from pipelines.alphavantage import AlphaVantageClient
+from pipelines.client import Client
+from pipelines.earthquakes import EarthQuakeClient
+from pipelines.openweather import OpeanWeatherClient
+from pipelines.result import ClientResult
+from utils.metrics import Metrics, frame_bytes, write_prometheus
+
+CLIENTS = {"weather": OpeanWeatherClient, "stocks": AlphaVantageClient, "earthquake": EarthQuakeClient}
+QUEUED_BATCHES = 4 # streamed batches waiting for the store, a fetcher waits while the queue is full
+
+def create_client(name:str, store_path:Path|None=None, backend:str="hdf5") -> Client:
+    if name not in CLIENTS:
+        raise ValueError(f"Unknown client: {name}")
+    if name == "stocks":
+        # the stocks client reads its watermarks and quota from the datastore
+        return AlphaVantageClient(datastore=DataStore(store_path, backend=backend))
+    return CLIENTS[name]()
+
+def _fetch(name:str, store_path:Path|None, backend:str, trace_memory:bool=False) -> Tuple[ClientResult, Dict[str, Dict]]:
+    # runs in a worker thread or process, only the result and the measured stages are sent back.
+    # The fetch stage covers the whole fetch including the process stages of the client
+    client = create_client(name, store_path, backend)
+    client.metrics.trace_memory = trace_memory
+    with client.metrics.stage("fetch") as record:
+        result = client.fetch()
+        record["rows"] = len(result.data) if result.data is not None else 0
+        record["bytes"] = client.metrics.received_bytes
+    return result, client.metrics.stages
+
+def _stream(name:str, store_path:Path|None, backend:str, trace_memory:bool, spool:Spool|None, batches) -> Tuple[int, int, Dict[str, Dict]]:
+    # Like _fetch, but every batch leaves the worker as soon as it is fetched: into the spool, or through
+    # the batches queue to the runner, which stores it. Only the row and error counts are sent back.
+    # The fetch stage includes the time spent waiting for a full queue
+    client = create_client(name, store_path, backend)
+    client.metrics.trace_memory = trace_memory
+    rows = 0
+    errors = 0
+    with client.metrics.stage("fetch") as record:
+        for result in client.stream():
+            rows += len(result.data) if result.data is not None else 0
+            errors += len(result.errors or [])
+            if spool is not None:
+                spool.put(name, result, client.SPLIT_ON)
+            else:
+                batches.put((name, result))
+        record["rows"] = rows
+        record["bytes"] = client.metrics.received_bytes
+    return rows, errors, client.metrics.stages
+
+def _store(datastore:DataStore, metrics:Metrics, name:str, result:ClientResult) -> int:
+    with metrics.stage("store") as record:
+        rows = datastore.store(name, result, CLIENTS[name].SPLIT_ON, bulk=True)
+        record["rows"] = rows
+        record["bytes"] = frame_bytes(result.data)
+    return rows
+
+def _store_batches(batches, futures:Dict[Future, str], datastore:DataStore, metrics:Dict[str, Metrics]) -> Tuple[Dict[str, int], Dict[str, str]]:
+    # Stores the streamed batches until every worker is done. A client whose batch cannot be stored is
+    # failed, its following batches are dropped, the queue is still emptied so that no worker waits forever
+    stored = {}
+    failed = {}
+    while True:
+        try:
+            name, result = batches.get(timeout=0.1)
+        except queue.Empty:
+            if all(future.done() for future in futures) and batches.empty():
+                return stored, failed
+            continue
+        if name in failed:
+            continue
+        try:
+            stored[name] = stored.get(name, 0) + _store(datastore, metrics[name], name, result)
+        except Exception as e:
+            failed[name] = repr(e)
+
+def run(clients:List[str], store_path:Path|None=None, backend:str="hdf5", spool:Spool|None=None,
+        workers:int|None=None, processes:bool=False, trace_memory:bool=False, prometheus_path:Path|None=None,
+        stream:bool=False) -> Dict[str, Dict]:
+    # Fetches the clients concurrently. Every result is stored as soon as its client is done, by this
+    # process only, so the datastore has a single writer. With a spool the results are only buffered
+    # for the drain task. A failing client does not stop the others, its error is part of the summary.
+    # With stream the clients hand over their batches (pages, groups of cities) one by one instead of one
+    # result at the end, they are spooled by the workers or stored here as they arrive, so the memory is
+    # bounded by a few batches. The stage metrics are written into the metrics node of the client and
+    # optionally as prometheus text
+    unknown = [name for name in clients if name not in CLIENTS]
+    if unknown:
+        raise ValueError(f"Unknown clients: {unknown}")
+    if trace_memory and not processes and len(clients) > 1:
+        # tracemalloc traces the whole process, clients in threads would measure each other's allocations
+        raise ValueError("Tracing the memory of several clients requires worker processes")
+    datastore = DataStore(store_path, backend=backend) if spool is None else None
+    metrics = {name: Metrics(name, trace_memory) for name in clients}
+    summary = {}
+    records = []
+    pool = ProcessPoolExecutor if processes else ThreadPoolExecutor
+    with ExitStack() as stack:
+        batches = None
+        if stream and spool is None:
+            # the manager is entered first, it has to outlive the worker processes
+            batches = stack.enter_context(Manager()).Queue(QUEUED_BATCHES) if processes else queue.Queue(QUEUED_BATCHES)
+        executor = stack.enter_context(pool(max_workers=workers or len(clients) or 1))
+        if stream:
+            futures = {executor.submit(_stream, name, store_path, backend, trace_memory, spool, batches): name for name in clients}
+        else:
+            futures = {executor.submit(_fetch, name, store_path, backend, trace_memory): name for name in clients}
+        stored, failed = _store_batches(batches, futures, datastore, metrics) if batches is not None else ({}, {})
+        for future in as_completed(futures):
+            name = futures[future]
+            try:
+                if stream:
+                    rows, errors, stages = future.result()
+                else:
+                    result, stages = future.result()
+            except Exception as e:
+                summary[name] = {"rows": stored.get(name, 0), "errors": 0, "stages": {}, "error": repr(e)}
+                continue
+            if name in failed:
+                summary[name] = {"rows": stored.get(name, 0), "errors": errors, "stages": {}, "error": failed[name]}
+                continue
+            metrics[name].merge(stages)
+            split_on = CLIENTS[name].SPLIT_ON
+            if not stream:
+                errors = len(result.errors or [])
+                if spool is not None:
+                    spool.put(name, result, split_on)
+                    rows = len(result.data) if result.data is not None else 0
+                else:
+                    rows = _store(datastore, metrics[name], name, result)
+            elif spool is None:
+                # the streamed batches are already stored, the spooled ones are counted by the worker
+                rows = stored.get(name, 0)
+            # with a spool the metrics node is written by the drain task as well
+            result = ClientResult(data=None, metadata=None, errors=None, metrics=metrics[name].records())
+            if spool is not None:
+                spool.put(name, result, split_on)
+            else:
+                datastore.store(name, result, split_on)
+            records.extend(metrics[name].records())
+            summary[name] = {"rows": rows, "errors": errors, "stages": metrics[name].stages, "error": None}
+    if prometheus_path is not None:
+        write_prometheus(records, prometheus_path)
+    return summary
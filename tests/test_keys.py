@@ -0,0 +1,67 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from datastore.datastore import DataStore
+from datastore.keys import KeyIndex
+from pipelines.result import ClientResult
+
+def earthquakes(ids, days) -> pd.DataFrame:
+    timestamps = pd.to_datetime([f"2025-08-{day:02d} 12:00" for day in days])
+    return pd.DataFrame({"timestamp": timestamps, "magnitude": np.arange(len(ids), dtype="float64"), "id": ids,
+                         "split_on": timestamps.strftime("date_%Y_%m_%d")})
+
+@pytest.fixture(params=["hdf5", "parquet"])
+def open_store(request, tmp_path):
+    # every call opens the same store again, without the keys loaded by the previous instances
+    path = tmp_path / ("datastore.h5" if request.param == "hdf5" else "datastore")
+    return lambda: DataStore(path, backend=request.param, rollups=False)
+
+def test_hash_ignores_the_datetime_resolution():
+    df = pd.DataFrame({"timestamp": pd.to_datetime(["2025-08-08 12:00", "2025-08-09 12:00"])})
+    coarse = df.astype({"timestamp": "datetime64[s]"})
+    assert np.array_equal(KeyIndex.hash(df, ["timestamp"]), KeyIndex.hash(coarse, ["timestamp"]))
+
+def test_hash_of_the_index_and_of_several_columns():
+    df = pd.DataFrame({"lon": [1.0, 1.0], "lat": [2.0, 3.0]}, index=pd.to_datetime(["2025-08-08", "2025-08-08"]))
+    assert KeyIndex.hash(df, ["index"])[0] == KeyIndex.hash(df, ["index"])[1]
+    assert KeyIndex.hash(df, ["lon", "lat"])[0] != KeyIndex.hash(df, ["lon", "lat"])[1]
+
+def test_contains_add_and_load():
+    index = KeyIndex()
+    hashes = np.array([30, 10, 20], dtype=np.uint64)
+    assert not index.contains("/node", hashes).any()
+    # nodes that were never loaded are not extended, the stored keys are read on first use
+    index.add("/node", hashes)
+    assert not index.loaded("/node")
+    index.load("/node", hashes)
+    assert index.contains("/node", np.array([5, 10, 25, 30, 40], dtype=np.uint64)).tolist() == [False, True, False, True, False]
+    index.add("/node", np.array([40, 10], dtype=np.uint64))
+    assert index.contains("/node", np.array([40, 35], dtype=np.uint64)).tolist() == [True, False]
+
+def test_drop_duplicates_in_the_frame_and_per_group(open_store):
+    datastore = open_store()
+    # the same id on another day is kept, the nodes are deduplicated separately
+    df = earthquakes(["a", "a", "b", "a"], [8, 8, 8, 9])
+    assert datastore.store("earthquake", ClientResult(df, None, None), "split_on") == 3
+    stored = datastore.query("earthquake")
+    assert sorted(zip(stored["split_on"], stored["id"])) == [("date_2025_08_08", "a"), ("date_2025_08_08", "b"),
+                                                             ("date_2025_08_09", "a")]
+
+def test_drop_duplicates_of_stored_rows(open_store):
+    open_store().store("earthquake", ClientResult(earthquakes(["a", "b"], [8, 9]), None, None), "split_on")
+    # a fresh store reads the stored keys of the nodes
+    reopened = open_store()
+    df = earthquakes(["a", "b", "c", "d"], [8, 9, 9, 10])
+    assert reopened.store("earthquake", ClientResult(df, None, None), "split_on") == 2
+    assert reopened.store("earthquake", ClientResult(df, None, None), "split_on") == 0
+    assert sorted(reopened.query("earthquake")["id"]) == ["a", "b", "c", "d"]
+
+def test_nodes_stored_without_the_key(open_store):
+    # nodes written before the key column existed have no key, their rows are never dropped
+    open_store().store("earthquake", ClientResult(earthquakes(["a"], [8]).drop(columns="id"), None, None), "split_on", keys=[])
+    reopened = open_store()
+    df = earthquakes(["a", "a"], [8, 8])
+    assert reopened.store("earthquake", ClientResult(df, None, None), "split_on") == 1
+    assert reopened.store("earthquake", ClientResult(df, None, None), "split_on") == 0
+    assert len(reopened.query("earthquake")) == 2
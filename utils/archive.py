@@ -0,0 +1,96 @@
+import gzip
+import json
+from pathlib import Path
+from datetime import datetime
+from typing import Any, Iterator, List, Tuple
+
+try:
+    import zstandard
+except ImportError: # zstd is optional, gzip is always available
+    zstandard = None
+
+class RawArchive:
+    # Append-only archive of the raw API responses of one API.
+    # Every response is one JSON line of a daily segment, e.g. data/raw/weather/20250808_weather.jsonl.gz.
+    # Each line is compressed as its own gzip member / zstd frame and written with a single append,
+    # so a segment stays readable even if a run is killed in the middle of a write
+    SUFFIXES = {"gzip": ".jsonl.gz", "zstd": ".jsonl.zst"}
+
+    def __init__(self, api_name:str, directory:Path|None=None, compression:str="gzip") -> None:
+        if compression not in RawArchive.SUFFIXES:
+            raise ValueError(f"Invalid compression for raw archive: {compression}")
+        if compression == "zstd" and zstandard is None:
+            raise ValueError("zstd compression requires the zstandard package")
+        if directory is None:
+            directory = Path(__file__).resolve().parents[1].joinpath(fr"data/raw/{api_name}")
+        self.api_name = api_name
+        self.directory = Path(directory)
+        self.compression = compression
+
+    def _compress(self, data:bytes) -> bytes:
+        if self.compression == "zstd":
+            return zstandard.ZstdCompressor().compress(data)
+        return gzip.compress(data)
+
+    def append(self, raw_data:Any) -> Path:
+        self.directory.mkdir(parents=True, exist_ok=True)
+        now = datetime.now()
+        segment = self.directory.joinpath(f"{now.strftime('%Y%m%d')}_{self.api_name}{RawArchive.SUFFIXES[self.compression]}")
+        line = json.dumps({"archived_at": now.isoformat(), "data": raw_data}) + "\n"
+        with segment.open("ab") as output:
+            output.write(self._compress(line.encode("utf-8")))
+        return segment
+
+    def _lines(self, segment:Path) -> Iterator[bytes]:
+        if segment.name.endswith(RawArchive.SUFFIXES["gzip"]):
+            with gzip.open(segment, "rb") as source:
+                yield from source
+            return
+        if zstandard is None:
+            raise ValueError(f"zstd compression requires the zstandard package to read {segment}")
+        # the zstd stream reader cannot be iterated line by line
+        with segment.open("rb") as raw, zstandard.ZstdDecompressor().stream_reader(raw, read_across_frames=True) as source:
+            buffer = b""
+            while chunk := source.read(1 << 16):
+                *lines, buffer = (buffer + chunk).split(b"\n")
+                yield from lines
+            if buffer:
+                yield buffer
+
+    def _read_segment(self, segment:Path) -> Iterator[Tuple[datetime, Any]]:
+        for line in self._lines(segment):
+            if line.strip():
+                record = json.loads(line)
+                yield datetime.fromisoformat(record["archived_at"]), record["data"]
+
+    def files(self) -> List[Path]:
+        # segments and legacy JSON files in chronological order
+        if not self.directory.exists():
+            return []
+        files = [path for path in self.directory.iterdir()
+                 if path.name.endswith(".json") or any(path.name.endswith(suffix) for suffix in RawArchive.SUFFIXES.values())]
+        return sorted(files, key=lambda path: path.name)
+
+    def read(self, path:Path, start:datetime|None=None, end:datetime|None=None) -> Iterator[Tuple[datetime, Any]]:
+        # records of a single segment or legacy JSON file
+        path = Path(path)
+        in_range = lambda archived_at: (start is None or archived_at >= start) and (end is None or archived_at < end)
+        if path.name.endswith(".json"):
+            try:
+                archived_at = datetime.strptime("_".join(path.name.split("_")[:2]), "%Y%m%d_%H%M%S")
+            except ValueError:
+                # not an archived response, e.g. a test output
+                return
+            if in_range(archived_at):
+                with path.open() as source:
+                    yield archived_at, json.load(source)
+            return
+        for archived_at, raw_data in self._read_segment(path):
+            if in_range(archived_at):
+                yield archived_at, raw_data
+
+    def replay(self, start:datetime|None=None, end:datetime|None=None) -> Iterator[Tuple[datetime, Any]]:
+        # Yields (archived_at, raw_data) in chronological order. The pretty printed JSON files
+        # written before the archive existed are replayed as well, their time is taken from the file name
+        for path in self.files():
+            yield from self.read(path, start, end)
@@ -0,0 +1,66 @@
+import csv
+import os
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+class GeocodingCache:
+    # On-disk cache for the coordinates of the cities in config/cities.csv.
+    # Entries are keyed by (city, country) as written in the config file, so a renamed city or a
+    # changed country is a cache miss and is geocoded again
+    FIELDNAMES = ("city", "country", "lon", "lat")
+
+    def __init__(self, cache_path:Path|None=None) -> None:
+        if cache_path is None:
+            cache_path = Path(__file__).resolve().parents[1].joinpath("config/geocoding_cache.csv")
+        self.cache_path = Path(cache_path)
+        self.hits = 0
+        self.misses = 0
+        self._entries = self._load()
+        self._dirty = False
+
+    def _load(self) -> Dict[Tuple[str, str], Dict]:
+        if not self.cache_path.exists():
+            return {}
+        with self.cache_path.open(newline="") as source:
+            reader = csv.DictReader(source, fieldnames=GeocodingCache.FIELDNAMES, delimiter=";")
+            return {(row["city"], row["country"]): {"city": row["city"],
+                                                    "country": row["country"],
+                                                    "lon": float(row["lon"]),
+                                                    "lat": float(row["lat"])}
+                    for row in reader}
+
+    def get(self, city:str, country:str) -> Dict|None:
+        entry = self._entries.get((city, country))
+        if entry is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return entry
+
+    def rows(self, keys:List[Tuple[str, str]]) -> List[Dict]:
+        # cached entries in the order of keys, unknown keys are skipped and not counted
+        return [self._entries[key] for key in keys if key in self._entries]
+
+    def put(self, city:str, country:str, lon:float, lat:float) -> None:
+        self._entries[(city, country)] = {"city": city, "country": country, "lon": lon, "lat": lat}
+        self._dirty = True
+
+    def invalidate(self, city:str|None=None, country:str|None=None) -> None:
+        # without arguments the whole cache is dropped, otherwise only the matching entries
+        keys = [key for key in self._entries
+                if (city is None or key[0] == city) and (country is None or key[1] == country)]
+        for key in keys:
+            del self._entries[key]
+        self._dirty = self._dirty or bool(keys)
+
+    def save(self) -> None:
+        if not self._dirty:
+            return
+        self.cache_path.parent.mkdir(parents=True, exist_ok=True)
+        # write to a temporary file first so that a concurrent run never reads a half written cache
+        tmp_path = self.cache_path.with_suffix(".tmp")
+        with tmp_path.open("w", newline="") as output:
+            writer = csv.DictWriter(output, fieldnames=GeocodingCache.FIELDNAMES, delimiter=";")
+            writer.writerows(self._entries.values())
+        os.replace(tmp_path, self.cache_path)
+        self._dirty = False
@@ -2,7 +2,9 @@ import csv
 import json
 from pathlib import Path
 from datetime import datetime
-from typing import List, Dict
+from typing import List, Dict, Tuple
+
+from utils.archive import RawArchive
 
 def get_url(api_name:str) -> str:
     with Path(__file__).parent.parent.joinpath(r"pipelines/sources.csv").open(newline="") as source:
@@ -12,13 +14,18 @@ def get_url(api_name:str) -> str:
                 return row["url"]
     return None # pyright: ignore[reportReturnType]
 
-def load_openweather_cities() -> List[str]:
+def load_openweather_locations() -> List[Tuple[str,str]]:
     with Path(__file__).parent.parent.joinpath(r"config/cities.csv").open(newline="") as source:
         reader = csv.DictReader(source, fieldnames=("city","country"), delimiter=";")
-        cities = [row["city"] for row in reader]
-    return cities
+        locations = [(row["city"], row["country"]) for row in reader]
+    return locations
 
-def store(raw_data:List[Dict], api_name:str) -> None:
+def store(raw_data:List[Dict], api_name:str, compression:str|None="gzip") -> None:
+    # the raw responses are appended to the compressed daily segments of the raw archive,
+    # compression=None writes one pretty printed JSON file per call like before
+    if compression is not None:
+        RawArchive(api_name, compression=compression).append(raw_data)
+        return
     # get the project's root directory
     raw_data_directory = Path(__file__).resolve().parents[1].joinpath(fr"data/raw/{api_name}")
     raw_data_directory.mkdir(parents=True, exist_ok=True)
@@ -0,0 +1,156 @@
+import gzip
+import hashlib
+import json
+import os
+import time
+import requests
+from pathlib import Path
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+from typing import Dict
+from urllib.parse import parse_qsl, urlencode, urlsplit
+
+from utils.helpers import get_url
+
+# seconds a cached response is used without asking the API again, per endpoint of pipelines/sources.csv
+TTLS = {"geocoding": 30 * 86400, # coordinates of a city do not change
+        "weather": 10 * 60, # the current weather is updated about every 10 minutes
+        "stocks": 6 * 3600, # daily series, reruns on the same day do not use the quota again
+        "earthquake": 3600}
+# query parameters that are not part of the cache key, the API keys are never written to disk
+IGNORED_PARAMS = {"appid", "apikey", "date"}
+KEEP = 7 * 86400 # entries older than this are removed, older ones could only be revalidated
+
+class ResponseCache:
+    # On disk cache of GET responses: {directory}/{endpoint}/{key}.json with the headers and {key}.gz with the body.
+    # Entries are written to a temporary file and renamed, so several processes can share the directory
+    def __init__(self, directory:Path|None=None, ttls:Dict[str, int]|None=None, keep:int=KEEP,
+                 endpoints:Dict[str, str]|None=None) -> None:
+        if directory is None:
+            directory = Path(__file__).resolve().parents[1].joinpath("data/http_cache")
+        self.directory = Path(directory)
+        self.ttls = ttls if ttls is not None else TTLS
+        self.keep = keep
+        if endpoints is None:
+            endpoints = {name: get_url(name) for name in self.ttls if get_url(name)}
+        self.endpoints = {name: url.split("?")[0].rstrip("/") for name, url in endpoints.items()}
+        self.prune()
+
+    def endpoint(self, url:str) -> str|None:
+        base = url.split("?")[0].rstrip("/")
+        for name, endpoint_url in self.endpoints.items():
+            if base == endpoint_url:
+                return name
+        return None
+
+    def _paths(self, url:str):
+        parts = urlsplit(url)
+        params = sorted((key, value) for key, value in parse_qsl(parts.query) if key not in IGNORED_PARAMS)
+        key = hashlib.sha256(f"{parts.netloc}{parts.path}?{urlencode(params)}".encode()).hexdigest()
+        directory = self.directory / self.endpoint(url)
+        return directory / f"{key}.json", directory / f"{key}.gz"
+
+    def get(self, url:str) -> Dict|None:
+        meta_path, body_path = self._paths(url)
+        try:
+            with meta_path.open() as source:
+                entry = json.load(source)
+            entry["content"] = gzip.decompress(body_path.read_bytes())
+        except (FileNotFoundError, ValueError, OSError):
+            # missing or removed by another process while reading
+            return None
+        return entry
+
+    def fresh(self, url:str, entry:Dict) -> bool:
+        return time.time() - entry["stored_at"] < self.ttls[self.endpoint(url)]
+
+    def _write(self, path:Path, data:bytes) -> None:
+        tmp_path = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+        tmp_path.write_bytes(data)
+        os.replace(tmp_path, path)
+
+    def put(self, url:str, response:requests.Response) -> None:
+        meta_path, body_path = self._paths(url)
+        meta_path.parent.mkdir(parents=True, exist_ok=True)
+        headers = {key: value for key, value in response.headers.items()
+                   if key.lower() in ("content-type", "etag", "last-modified", "date")}
+        # the body first, an entry only counts once its headers exist
+        self._write(body_path, gzip.compress(response.content))
+        self._write(meta_path, json.dumps({"stored_at": time.time(), "headers": headers}).encode())
+
+    def touch(self, url:str, entry:Dict) -> None:
+        # the API confirmed that the cached response is still valid (304)
+        meta_path, _ = self._paths(url)
+        self._write(meta_path, json.dumps({"stored_at": time.time(), "headers": entry["headers"]}).encode())
+
+    def invalidate(self, url:str) -> None:
+        for path in self._paths(url):
+            path.unlink(missing_ok=True)
+
+    def prune(self) -> None:
+        if not self.directory.exists():
+            return
+        limit = time.time() - self.keep
+        for meta_path in self.directory.glob("*/*.json"):
+            try:
+                if meta_path.stat().st_mtime < limit:
+                    meta_path.unlink(missing_ok=True)
+                    meta_path.with_suffix(".gz").unlink(missing_ok=True)
+            except FileNotFoundError:
+                continue
+
+class CachingAdapter(HTTPAdapter):
+    # Pooled transport adapter that answers GET requests of known endpoints from the response cache.
+    # Fresh entries are returned without a request, stale ones are revalidated with If-None-Match /
+    # If-Modified-Since and a 304 returns the cached body. Responses with a cached body have from_cache=True,
+    # revalidated=True if the API was asked
+    def __init__(self, cache:ResponseCache, **kwargs) -> None:
+        super().__init__(**kwargs)
+        self.cache = cache
+
+    def _cached(self, request:requests.PreparedRequest, entry:Dict, revalidated:bool=False) -> requests.Response:
+        response = requests.Response()
+        response.status_code = 200
+        response.reason = "OK"
+        response.headers = CaseInsensitiveDict(entry["headers"])
+        response.encoding = get_encoding_from_headers(response.headers)
+        response._content = entry["content"]
+        response.url = request.url
+        response.request = request
+        response.from_cache = True
+        response.revalidated = revalidated
+        return response
+
+    def send(self, request:requests.PreparedRequest, **kwargs) -> requests.Response:
+        if request.method != "GET" or self.cache.endpoint(request.url) is None:
+            return super().send(request, **kwargs)
+        entry = self.cache.get(request.url)
+        if entry is not None:
+            if self.cache.fresh(request.url, entry):
+                return self._cached(request, entry)
+            headers = CaseInsensitiveDict(entry["headers"])
+            if "etag" in headers:
+                request.headers["If-None-Match"] = headers["etag"]
+            if "last-modified" in headers:
+                request.headers["If-Modified-Since"] = headers["last-modified"]
+        response = super().send(request, **kwargs)
+        if response.status_code == 304 and entry is not None:
+            self.cache.touch(request.url, entry)
+            response.close()
+            return self._cached(request, entry, revalidated=True)
+        if response.status_code == 200:
+            self.cache.put(request.url, response)
+        response.from_cache = False
+        response.revalidated = False
+        return response
+
+def create_session(pool_maxsize:int=4, cache:ResponseCache|None=None) -> requests.Session:
+    # one pooled session per client, compressed transfers and the shared response cache
+    session = requests.Session()
+    session.headers["Accept-Encoding"] = "gzip, deflate"
+    session.response_cache = cache if cache is not None else ResponseCache()
+    adapter = CachingAdapter(session.response_cache, pool_connections=4, pool_maxsize=pool_maxsize)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
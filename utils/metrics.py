@@ -0,0 +1,152 @@
+import functools
+import math
+import os
+import resource
+import threading
+import time
+import tracemalloc
+import pandas as pd
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, List
+
+# stages with memory tracing running at the moment, in any Metrics of the process
+_traced_stages = 0
+_tracing_lock = threading.Lock()
+
+def _max(a:float, b:float) -> float:
+    # NaN means not measured
+    if math.isnan(a):
+        return b
+    if math.isnan(b):
+        return a
+    return max(a, b)
+
+class Metrics:
+    # Per stage measurements of one client run (fetch, process, store). Every stage is aggregated over its calls:
+    # seconds -> wall time summed over the calls, rows -> rows of the produced frames,
+    # bytes -> received from the API for fetch, in-memory size of the frames for process and store,
+    # peak_memory_bytes -> peak of the traced Python allocations while the stage ran, only with trace_memory
+    #                      (NaN otherwise). tracemalloc is process wide: the peak of a nested or concurrent
+    #                      stage is the peak since the outermost running stage began, and with several
+    #                      clients in threads it includes the other clients, see runner.run
+    # max_rss_bytes -> largest resident set size of the process so far, a lifetime high-water mark, not per stage
+    def __init__(self, client:str, trace_memory:bool=False) -> None:
+        self.client = client
+        self.trace_memory = trace_memory
+        self.stages:Dict[str, Dict] = {}
+        self.received_bytes = 0
+        self._lock = threading.Lock()
+
+    def count_response(self, response, *args, **kwargs):
+        # response hook of a requests session, responses from the cache did not go over the network
+        if getattr(response, "from_cache", False):
+            return response
+        with self._lock:
+            self.received_bytes += len(response.content)
+        return response
+
+    def _start_tracing(self) -> None:
+        # The peak is only reset when no other stage is traced, a reset would lose the peak of the running stages.
+        # Tracing slows down the allocations, it is only started when asked for
+        global _traced_stages
+        with _tracing_lock:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+            if _traced_stages == 0:
+                tracemalloc.reset_peak()
+            _traced_stages += 1
+
+    def _stop_tracing(self) -> float:
+        global _traced_stages
+        with _tracing_lock:
+            _traced_stages -= 1
+            return float(tracemalloc.get_traced_memory()[1])
+
+    def _stage(self, name:str) -> Dict:
+        return self.stages.setdefault(name, {"calls": 0, "seconds": 0.0, "rows": 0, "bytes": 0,
+                                             "peak_memory_bytes": float("nan"), "max_rss_bytes": 0})
+
+    @contextmanager
+    def stage(self, name:str):
+        # the caller can fill rows and bytes of the yielded record
+        record = {"rows": 0, "bytes": 0}
+        if self.trace_memory:
+            self._start_tracing()
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            seconds = time.perf_counter() - start
+            peak = self._stop_tracing() if self.trace_memory else float("nan")
+            # ru_maxrss is in KB on linux
+            max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+            with self._lock:
+                stage = self._stage(name)
+                stage["calls"] += 1
+                stage["seconds"] += seconds
+                stage["rows"] += record["rows"]
+                stage["bytes"] += record["bytes"]
+                stage["peak_memory_bytes"] = _max(stage["peak_memory_bytes"], peak)
+                stage["max_rss_bytes"] = max(stage["max_rss_bytes"], max_rss)
+
+    def merge(self, stages:Dict[str, Dict]) -> None:
+        # stages measured in another process
+        with self._lock:
+            for name, measured in stages.items():
+                stage = self._stage(name)
+                for field in ("calls", "seconds", "rows", "bytes"):
+                    stage[field] += measured[field]
+                stage["peak_memory_bytes"] = _max(stage["peak_memory_bytes"], measured["peak_memory_bytes"])
+                stage["max_rss_bytes"] = max(stage["max_rss_bytes"], measured["max_rss_bytes"])
+
+    def records(self) -> List[Dict]:
+        # one metadata record per stage
+        timestamp = datetime.now().isoformat()
+        with self._lock:
+            return [{"timestamp": timestamp, "client": self.client, "stage": name, **stage} for name, stage in self.stages.items()]
+
+def frame_bytes(df:pd.DataFrame|None) -> int:
+    return int(df.memory_usage(index=True, deep=True).sum()) if df is not None else 0
+
+def timed(stage:str, count_rows:bool=True):
+    # Decorator for the methods of a client with a `metrics` attribute, a returned frame counts as rows and bytes.
+    # count_rows=False for intermediate frames, their rows are counted again by the following steps
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(self, *args, **kwargs):
+            with self.metrics.stage(stage) as record:
+                result = function(self, *args, **kwargs)
+                if count_rows and isinstance(result, pd.DataFrame):
+                    record["rows"] = len(result)
+                    record["bytes"] = frame_bytes(result)
+            return result
+        return wrapper
+    return decorator
+
+def to_prometheus(records:List[Dict]) -> str:
+    # text exposition format, e.g. for the textfile collector of the node exporter
+    lines = []
+    for field, help_text in (("seconds", "Wall time of the stage"),
+                             ("rows", "Rows produced by the stage"),
+                             ("bytes", "Bytes received (fetch) or in-memory size of the frames (process, store)"),
+                             ("peak_memory_bytes", "Peak of the traced allocations during the stage (--trace-memory only)"),
+                             ("max_rss_bytes", "Largest resident set size of the process so far, not per stage"),
+                             ("calls", "Calls of the stage")):
+        lines.append(f"# HELP pipeline_stage_{field} {help_text}")
+        lines.append(f"# TYPE pipeline_stage_{field} gauge")
+        for record in records:
+            if isinstance(record[field], float) and math.isnan(record[field]):
+                # not measured
+                continue
+            lines.append(f'pipeline_stage_{field}{{client="{record["client"]}",stage="{record["stage"]}"}} {record[field]}')
+    return "\n".join(lines) + "\n"
+
+def write_prometheus(records:List[Dict], path:Path) -> None:
+    # written atomically, the collector never reads a half written file
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(f".{path.name}.tmp")
+    tmp_path.write_text(to_prometheus(records))
+    os.replace(tmp_path, path)
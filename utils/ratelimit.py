@@ -0,0 +1,30 @@
+import threading
+import time
+
+class TokenBucket:
+    # Thread-safe token bucket. Every request takes one token, tokens are refilled at a fixed
+    # rate and at most `capacity` tokens can be stored, which allows short bursts
+    def __init__(self, rate:float, capacity:int|None=None) -> None:
+        if rate <= 0:
+            raise ValueError(f"Invalid rate for token bucket: {rate}")
+        self.rate = rate # tokens per second
+        self.capacity = capacity if capacity is not None else max(1, int(rate))
+        self._tokens = float(self.capacity)
+        self._last_refill = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._last_refill) * self.rate)
+        self._last_refill = now
+
+    def acquire(self) -> None:
+        # blocks until a token is available
+        while True:
+            with self._lock:
+                self._refill()
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)